@@ -0,0 +1,200 @@
+import numpy as np
+import pandas as pd
+from statistics import NormalDist
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from tools.game_tools import Game, load_model
+from tools.player_tools import RandomPlayer, SimplePlayer, SearchPlayer, RNNPlayer
+
+#---------------------------------------------------------------------------------------------
+# arena: the players of a roster play matches against each other (draws included, unlike simulation())
+# and get a rating on the Elo scale, fitted with the Bradley-Terry model
+# each player is described by a spec, which can be sent to the worker processes: the name of the
+# player kind ('random', 'simple', 'search', 'rnn') or a (kind, arguments) tuple, e.g.
+#   ('search', {'node_limit' : 20_000}), ('rnn', {'path' : 'models/1st_model', 'backend' : 'numpy'})
+player_kinds = {'random' : RandomPlayer, 'simple' : SimplePlayer, 'search' : SearchPlayer, 'rnn' : RNNPlayer}
+
+def parse_spec(spec):
+    kind, arguments = (spec, {}) if isinstance(spec, str) else spec
+    if kind not in player_kinds:
+        raise ValueError(f'Unknown player kind {kind}, choose one of {list(player_kinds)}.')
+    return kind, dict(arguments)
+
+# the models are loaded only once in each process
+_models = {}
+def get_model(path, backend='numpy', mean_duration=21):
+    key = (path, backend, mean_duration)
+    if key not in _models:
+        _models[key] = load_model(path, backend=backend, mean_duration=mean_duration)
+    return _models[key]
+
+def make_player(spec, p=1, name=None, rng=None, mean_duration=21):
+    kind, arguments = parse_spec(spec)
+    if (kind == 'rnn') and ('path' in arguments):
+        arguments['model'] = get_model(arguments.pop('path'), arguments.pop('backend', 'numpy'), mean_duration)
+    return player_kinds[kind](p=p, name=name, rng=rng, **arguments)
+
+#---------------------------------------------------------------------------------------------
+# n games between two players, alternating the first move (player a starts the even games when first=0)
+# returns the wins of a, the wins of b and the draws
+def play_match(spec_a, spec_b, n_games, seed=None, engine='grid', mean_duration=21, first=0, grid_size=(6,7),
+               n_connect=4):
+    rng = np.random.default_rng(seed)
+    # one instance for each player and role, so that the search players keep their tables across games
+    players_a = {p : make_player(spec_a, p, 'a', rng, mean_duration) for p in [1, -1]}
+    players_b = {p : make_player(spec_b, p, 'b', rng, mean_duration) for p in [1, -1]}
+    results = np.zeros(3, dtype=np.int64)
+    for i in range(n_games):
+        if (first + i) % 2 == 0:
+            players = [players_a[1], players_b[-1]]
+        else:
+            players = [players_b[1], players_a[-1]]
+        game = Game(players=players, engine=engine, rng=rng, grid_size=grid_size, n_connect=n_connect)
+        game.play_game(record=False, mean_duration=mean_duration)
+        if not game.win:
+            results[2] += 1
+        elif game.Board.winner == players[0].player:
+            results[0 if players[0].name == 'a' else 1] += 1
+        else:
+            results[0 if players[1].name == 'a' else 1] += 1
+    return results
+
+def _play_match(args):
+    return play_match(*args)
+
+#---------------------------------------------------------------------------------------------
+# Bradley-Terry model: P(i beats j) = gamma_i / (gamma_i + gamma_j), fitted with the MM iterations
+# (draws count as half a win for both players); `prior` virtual draws between every pair of players keep
+# the strengths finite when a player never wins or never scores
+# returns the log-strengths (zero mean) and their covariance, from the information of the real games
+def bradley_terry(wins, draws, prior=1.0, iterations=10_000, tol=1e-10):
+    n = len(wins)
+    off_diagonal = 1 - np.eye(n)
+    scores = wins + 0.5 * draws + 0.5 * prior * off_diagonal
+    games = scores + scores.T
+    gamma = np.ones(n)
+    for _ in range(iterations):
+        new = scores.sum(axis=1) / (games / (gamma[:, None] + gamma[None, :])).sum(axis=1)
+        new /= np.exp(np.log(new).mean())
+        converged = np.abs(np.log(new) - np.log(gamma)).max() < tol
+        gamma = new
+        if converged:
+            break
+    theta = np.log(gamma)
+    p = gamma[:, None] / (gamma[:, None] + gamma[None, :])
+    information = (wins + wins.T + draws) * p * p.T * off_diagonal
+    information = np.diag(information.sum(axis=1)) - information
+    # pseudo-inverse: the strengths are only defined up to a constant (zero mean)
+    return theta, np.linalg.pinv(information)
+
+elo_scale = 400 / np.log(10)
+
+class Arena(object):
+    def __init__(self, roster, engine='grid', mean_duration=21, workers=None, seed=None, grid_size=(6,7),
+                 n_connect=4):
+        self.names = list(roster)           # roster: {name : spec}
+        self.specs = [roster[name] for name in self.names]
+        for spec in self.specs:
+            parse_spec(spec)
+        n = len(self.names)
+        self.wins = np.zeros(shape=(n, n), dtype=np.int64)     # wins[i, j]: games won by i against j
+        self.draws = np.zeros(shape=(n, n), dtype=np.int64)    # symmetric
+        self.first = np.zeros(shape=(n, n), dtype=np.int64)    # games started by i against j
+        self.engine = engine
+        self.mean_duration = mean_duration
+        self.grid_size = tuple(grid_size)
+        self.n_connect = n_connect
+        self.workers = workers
+        self.seeds = np.random.SeedSequence(seed)
+        self.executor = None
+
+    def index(self, name):
+        return self.names.index(name)
+
+    # the games of each pair are split into one chunk per worker: each chunk gets its own seed and
+    # keeps alternating the first move from where the previous chunk stopped
+    def run(self, pairs):
+        tasks = []
+        for i, j, n_games in pairs:
+            played = self.wins[i, j] + self.wins[j, i] + self.draws[i, j]
+            sizes = [len(chunk) for chunk in np.array_split(np.arange(n_games), self.workers or 1)]
+            for size in sizes:
+                if size > 0:
+                    tasks.append((i, j, size, played % 2))
+                    played += size
+        seeds = self.seeds.spawn(len(tasks))
+        args = [(self.specs[i], self.specs[j], size, seed, self.engine, self.mean_duration, first, self.grid_size,
+                 self.n_connect)
+                for (i, j, size, first), seed in zip(tasks, seeds)]
+        if (self.workers is None) or (self.workers == 1):
+            results = [_play_match(arg) for arg in args]
+        else:
+            # the pool (and the models loaded by its workers) is kept until close()
+            # spawn instead of fork: a forked child of a process that already ran TensorFlow can hang
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=mp.get_context('spawn'))
+            results = list(self.executor.map(_play_match, args))
+        for (i, j, size, first), (wins_i, wins_j, draws) in zip(tasks, results):
+            self.wins[i, j] += wins_i
+            self.wins[j, i] += wins_j
+            self.draws[i, j] += draws
+            self.draws[j, i] += draws
+            self.first[i, j] += (size + 1 - first) // 2
+            self.first[j, i] += (size + first) // 2
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    # every pair of players plays the same number of games
+    def round_robin(self, games_per_pair=20):
+        n = len(self.names)
+        self.run([(i, j, games_per_pair) for i in range(n) for j in range(i + 1, n)])
+        return self.ratings()
+
+    # ratings on the Elo scale with their confidence intervals: zero mean, or zero for the anchor player
+    def ratings(self, confidence=0.95, anchor=None, prior=1.0):
+        theta, covariance = bradley_terry(self.wins, self.draws, prior)
+        z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        variance = np.diag(covariance)
+        if anchor is not None:
+            a = self.index(anchor)
+            theta = theta - theta[a]
+            variance = variance + covariance[a, a] - 2 * covariance[:, a]
+        error = z * elo_scale * np.sqrt(np.maximum(variance, 0))
+        games = self.wins.sum(axis=1) + self.wins.sum(axis=0) + self.draws.sum(axis=1)
+        table = pd.DataFrame({'games' : games, 'wins' : self.wins.sum(axis=1), 'draws' : self.draws.sum(axis=1),
+                              'losses' : self.wins.sum(axis=0), 'elo' : elo_scale * theta},
+                             index=self.names)
+        table['score'] = (table['wins'] + 0.5 * table['draws']) / np.maximum(table['games'], 1)
+        table['low'] = table['elo'] - error
+        table['high'] = table['elo'] + error
+        return table.sort_values('elo', ascending=False)
+
+    # rating gap of a over b (Elo scale), using only their direct games
+    def gap(self, a, b, confidence=0.95, prior=1.0):
+        i, j = self.index(a), self.index(b)
+        pair = np.ix_([i, j], [i, j])
+        theta, covariance = bradley_terry(self.wins[pair], self.draws[pair], prior)
+        z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        gap = elo_scale * (theta[0] - theta[1])
+        error = z * elo_scale * np.sqrt(max(covariance[0, 0] + covariance[1, 1] - 2 * covariance[0, 1], 0))
+        return gap, gap - error, gap + error
+
+    # head-to-head comparison (e.g. two checkpoints) with early stopping: the games are played in
+    # batches until the confidence interval of the gap excludes 0 or max_games is reached
+    # the interval is checked after every batch, so a high confidence level is used by default
+    def compare(self, a, b, batch_size=20, min_games=40, max_games=2000, confidence=0.99):
+        i, j = self.index(a), self.index(b)
+        while True:
+            self.run([(i, j, batch_size)])
+            n_games = self.wins[i, j] + self.wins[j, i] + self.draws[i, j]
+            gap, low, high = self.gap(a, b, confidence)
+            settled = (low > 0) or (high < 0)
+            if (settled and (n_games >= min_games)) or (n_games >= max_games):
+                break
+        score = (self.wins[i, j] + 0.5 * self.draws[i, j]) / n_games
+        return {'games' : int(n_games), 'wins' : int(self.wins[i, j]), 'losses' : int(self.wins[j, i]),
+                'draws' : int(self.draws[i, j]), 'score' : float(score), 'gap' : float(gap), 'low' : float(low),
+                'high' : float(high), 'settled' : bool(settled)}
@@ -0,0 +1,210 @@
+import numpy as np
+import pandas as pd
+from tools.game_tools import window_tables, records_to_dataframe
+
+#---------------------------------------------------------------------------------------------
+# the batch engine plays many games at the same time: all the boards are stored inside a single
+# (n, height, width) int8 array and every step applies one move to each live game, checking the
+# winners of the whole batch with array operations
+class BatchBoard(object):
+    def __init__(self, n, grid_size=(6,7), mean_duration=None, n_connect=4):
+        self.height = grid_size[0]
+        self.width = grid_size[1]
+        self.n_positions = self.height * self.width
+        self.n_connect = n_connect
+
+        self.grid = np.zeros(shape=(n, self.height, self.width), dtype=np.int8)
+        # how many positions are left for each column of each board
+        self.column_n_pos = np.zeros(shape=(n, self.width), dtype=np.int16) + self.height
+        self.n_pos_left = np.zeros(n, dtype=np.int16) + self.n_positions
+
+        tables = window_tables(grid_size, n_connect)
+        self.windows = tables['windows']
+        self.window_columns = tables['columns']
+        self.window_groups = tables['groups']
+
+        # board states sequence of each game (only needed by the neural players), built as in Game.play_game
+        self.mean_duration = mean_duration
+        self.sequence = None
+        if mean_duration is not None:
+            self.sequence = np.zeros(shape=(n, mean_duration, self.n_positions), dtype=np.float32)
+
+    # flat (row-major) view of the boards, used to gather the windows
+    @property
+    def flat_grid(self):
+        return self.grid.reshape(len(self.grid), -1)
+
+    # keeps only the boards in the selected positions (boolean mask or indexes)
+    def select(self, index):
+        self.grid = self.grid[index]
+        self.column_n_pos = self.column_n_pos[index]
+        self.n_pos_left = self.n_pos_left[index]
+        if self.sequence is not None:
+            self.sequence = self.sequence[index]
+
+    # new batch board containing a copy of the selected boards
+    def subset(self, index):
+        board = BatchBoard(0, (self.height, self.width), n_connect=self.n_connect)
+        board.grid = self.grid[index]
+        board.column_n_pos = self.column_n_pos[index]
+        board.n_pos_left = self.n_pos_left[index]
+        if self.sequence is not None:
+            board.sequence = self.sequence[index]
+        return board
+
+    # the sequences are shifted by one step, adding the current boards (column by column) at the end
+    def update_sequence(self):
+        self.sequence[:, :-1] = self.sequence[:, 1:]
+        self.sequence[:, -1] = self.grid.transpose(0, 2, 1).reshape(len(self.grid), -1)
+
+    # one token for every board: choices and markers are arrays with one element per board
+    def update_grid(self, choices, markers):
+        games = np.arange(len(self.grid))
+        rows = self.column_n_pos[games, choices] - 1
+        self.grid[games, rows, choices] = markers
+        self.column_n_pos[games, choices] -= 1
+        self.n_pos_left -= 1
+
+    # returns a boolean array: True where the player with the given marker has filled a line
+    def check_winner(self, markers):
+        sums = self.flat_grid[:, self.windows].sum(axis=2, dtype=np.int16)
+        return (sums == self.n_connect * markers[:, None]).any(axis=1)
+
+#---------------------------------------------------------------------------------------------
+# policies: each one takes the batch board, the markers of the players to move and the random
+# generator, returning one column for each board
+def random_policy(board, markers, rng):
+    # random keys on the valid columns only, the full ones get a negative key
+    keys = rng.random(board.column_n_pos.shape)
+    keys[board.column_n_pos == 0] = -1
+    return keys.argmax(axis=1)
+
+# same strategy of the SimplePlayer class: the first group (rows, columns, diagonals) containing a
+# window that can be completed is used, giving priority to the defeat scenario inside the group
+def simple_policy(board, markers, rng):
+    choices = random_policy(board, markers, rng)
+    n_windows = len(board.windows)
+    groups = board.window_groups
+
+    flat_grid = board.flat_grid
+    cells = flat_grid[:, board.windows]                     # (n, windows, n_connect)
+    sums = cells.sum(axis=2, dtype=np.int16)
+    target = (board.n_connect - 1) * markers[:, None]
+    # sorting key: group first, then defeat before victory, then the window order
+    keys = np.where(sums == -target, 2 * groups, np.where(sums == target, 2 * groups + 1, 6))
+    keys = keys * n_windows + np.arange(n_windows)
+    found = keys.min(axis=1) < 6 * n_windows
+    if found.any():
+        games = np.flatnonzero(found)
+        window = keys[games].argmin(axis=1)
+        # column of the empty cell inside the selected window
+        empty = (cells[games, window] == 0).argmax(axis=1)
+        column = board.window_columns[window, empty]
+        valid = board.column_n_pos[games, column] > 0
+        choices[games[valid]] = column[valid]
+    return choices
+
+# the neural player scores the current sequences of all the games with a single model call per step:
+# the model is called directly (not through predict(), which has a large fixed cost for each call) 
+# inside a tf.function traced only once, thanks to the input signature with a free batch dimension
+# the other models (NumpyModel and TracedModel, see inference_tools.py) have no such fixed cost and cannot
+# always be traced (the NumPy forward pass needs actual arrays), so their predict() is called directly
+class RNNPolicy(object):
+    def __init__(self, model):
+        import tensorflow as tf
+        self.model = model
+        self.scorer = None
+        self.tf = tf
+
+    def __call__(self, board, markers, rng):
+        if not isinstance(self.model, self.tf.keras.Model):
+            probas = np.array(self.model.predict(board.sequence, verbose=0))
+        else:
+            if self.scorer is None:
+                signature = [self.tf.TensorSpec(shape=(None,) + board.sequence.shape[1:], dtype=self.tf.float32)]
+                self.scorer = self.tf.function(lambda x: self.model(x, training=False), input_signature=signature)
+            probas = self.scorer(board.sequence).numpy()
+        # the full columns can never be chosen: the highest valid probability gives the move
+        probas[board.column_n_pos == 0] = -np.inf
+        return probas.argmax(axis=1)
+
+policies = {'random' : (random_policy, 'RandomAI'),
+            'simple' : (simple_policy, 'SimpleAI'),
+            'rnn' : (RNNPolicy, 'RecurrentAI')}
+
+#---------------------------------------------------------------------------------------------
+# simulating N games in batches: games ending in a draw are discarded (like in simulation()) and the
+# index of each game follows the order in which the games end
+def batch_simulation(n=100, game_type='random-random', batch_size=10_000, grid_size=(6,7), seed=None,
+                     as_arrays=False, model=None, mean_duration=21, n_connect=4):
+    types = game_type.split('-')
+    if (len(types) != 2) or any(t not in policies for t in types):
+        raise ValueError(f'Game type {game_type} is not supported by the batch engine, '
+                         f'choose two players among {list(policies)}.')
+    if ('rnn' in types) and (model is None):
+        raise ValueError(f'Game type {game_type} requires a model.')
+    # the neural policy is shared by both players in the rnn-rnn case
+    functions = {t : (policies[t][0](model) if t == 'rnn' else policies[t][0]) for t in set(types)}
+    if 'rnn' not in types:
+        mean_duration = None
+    rng = np.random.default_rng(seed)
+    names = [f'{policies[t][1]}_{i + 1}' for i, t in enumerate(types)]
+    markers = np.array([1, -1], dtype=np.int8)
+
+    records = {'game' : [], 'move' : [], 'player' : [], 'choice' : [], 'boards' : []}
+    n_games = 0
+    while n_games < n:
+        # a few more games than needed, to make up for the draws
+        size = min(batch_size, int((n - n_games) * 1.02) + 10)
+        board = BatchBoard(size, grid_size, mean_duration, n_connect)
+        games = np.arange(size)                             # game id of each live board
+        first = rng.integers(0, 2, size=size)               # index of the starting player
+        batch = {key : [] for key in records}
+        winners = []
+        for move in range(board.n_positions):
+            players = (first + move) % 2
+            player_markers = markers[players]
+            if mean_duration is not None:
+                board.update_sequence()
+            choices = np.zeros(len(games), dtype=np.int64)
+            for i, t in enumerate(types):
+                turn = players == i
+                if turn.any():
+                    choices[turn] = functions[t](board.subset(turn), player_markers[turn], rng)
+            # the boards are saved before the update, column by column (as in Game.save_game)
+            batch['boards'].append(board.grid.transpose(0, 2, 1).reshape(len(games), -1))
+            batch['game'].append(games)
+            batch['move'].append(np.zeros(len(games), dtype=np.int16) + move)
+            batch['player'].append(players.astype(np.int8))
+            batch['choice'].append(choices.astype(np.int8))
+
+            board.update_grid(choices, player_markers)
+            win = board.check_winner(player_markers)
+            winners.append(games[win])
+            # finished games (winners and draws) are removed from the active set
+            alive = ~win & (board.n_pos_left > 0)
+            board.select(alive)
+            games = games[alive]
+            first = first[alive]
+            if len(games) == 0:
+                break
+
+        winners = np.concatenate(winners)[:n - n_games]
+        # new game index, following the winners order; -1 for draws and games beyond n
+        new_index = np.zeros(size, dtype=np.int64) - 1
+        new_index[winners] = np.arange(len(winners)) + n_games
+        batch = {key : np.concatenate(value) for key, value in batch.items()}
+        batch['game'] = new_index[batch['game']]
+        keep = batch['game'] >= 0
+        for key in records:
+            records[key].append(batch[key][keep])
+        n_games += len(winners)
+
+    records = {key : np.concatenate(value) for key, value in records.items()}
+    # sorting the moves by game (the order inside each game is already preserved)
+    order = np.argsort(records['game'], kind='stable')
+    records = {key : value[order] for key, value in records.items()}
+    records['names'] = names
+    if as_arrays:
+        return records
+    return records_to_dataframe(records, grid_size)
@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+from tools.game_tools import (engines, simulation, records_to_dataframe, read_json, RandomPlayer, SimplePlayer,
+                              SearchPlayer, RNNPlayer)
+
+#---------------------------------------------------------------------------------------------
+# benchmark suite: every benchmark uses fixed seeds and returns a flat dictionary of metrics, so that two
+# runs can be compared metric by metric; the rates ('..._per_sec') are better when higher, the times
+# ('..._sec') and the memory ('..._bytes') when lower
+# each measure is repeated and the best run is kept, to reduce the noise of the other processes
+
+# with setup, each repeat gets a fresh argument built outside the timed section (e.g. a new player)
+def best_time(function, repeat=3, setup=None):
+    times = []
+    for _ in range(repeat):
+        args = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+# the moves of n random games (one list of columns for each game), to replay them on every engine
+def random_games(n=1000, grid_size=(6,7), seed=0):
+    rng = np.random.default_rng(seed)
+    players = [RandomPlayer(p=1), RandomPlayer(p=-1)]
+    games = []
+    for _ in range(n):
+        board = engines['grid'](grid_size)
+        choices = []
+        win = False
+        while (not win) and (board.n_pos_left > 0):
+            player = players[len(choices) % 2]
+            player.choice = int(rng.choice(np.flatnonzero(board.column_n_pos)))
+            board.update_grid(player)
+            choices.append(player.choice)
+            win = board.check_winner(player)
+        games.append(choices)
+    return games
+
+# the boards reached after a random number of moves of the given games, used as starting positions
+def random_positions(games, grid_size=(6,7), seed=0):
+    rng = np.random.default_rng(seed)
+    players = [RandomPlayer(p=1), RandomPlayer(p=-1)]
+    positions = []
+    for choices in games:
+        board = engines['grid'](grid_size)
+        for i, choice in enumerate(choices[:rng.integers(0, len(choices))]):
+            player = players[i % 2]
+            player.choice = choice
+            board.update_grid(player)
+        positions.append(board)
+    return positions
+
+#---------------------------------------------------------------------------------------------
+# board engines: the same random games are replayed on each engine, timing update_grid() alone and
+# update_grid() followed by check_winner() for the player that moved
+def bench_board(n_games=2000, grid_size=(6,7), repeat=3, seed=0):
+    games = random_games(n_games, grid_size, seed)
+    n_moves = sum(len(choices) for choices in games)
+    metrics = {}
+    for name, engine in engines.items():
+        moves = min(replay_time(engine, games, grid_size, False) for _ in range(repeat))
+        both = min(replay_time(engine, games, grid_size, True) for _ in range(repeat))
+        metrics[f'board.{name}.moves_per_sec'] = n_moves / moves
+        metrics[f'board.{name}.win_checks_per_sec'] = n_moves / max(both - moves, 1e-9)
+    return metrics
+
+def replay_time(engine, games, grid_size=(6,7), check=False):
+    players = [RandomPlayer(p=1), RandomPlayer(p=-1)]
+    # the boards are built outside the timed part
+    boards = [engine(grid_size) for _ in games]
+    start = time.perf_counter()
+    for board, choices in zip(boards, games):
+        for i, choice in enumerate(choices):
+            player = players[i % 2]
+            player.choice = choice
+            board.update_grid(player)
+            if check:
+                board.check_winner(player)
+    return time.perf_counter() - start
+
+#---------------------------------------------------------------------------------------------
+# player decisions on the same set of random positions; the search player gets a fixed node budget
+# (instead of a time budget) and the neural player is only measured when a model is given
+def bench_players(n_positions=500, grid_size=(6,7), repeat=3, seed=0, model=None, mean_duration=21,
+                  search_nodes=2000):
+    positions = [board for board in random_positions(random_games(n_positions, grid_size, seed), grid_size, seed)
+                 if board.n_pos_left > 0]
+    # a new player for each repeat: the transposition table of the search player would otherwise answer the
+    # later repeats from the positions searched by the first one
+    players = {'random' : lambda: RandomPlayer(p=1, rng=np.random.default_rng(seed)),
+               'simple' : lambda: SimplePlayer(p=1, rng=np.random.default_rng(seed)),
+               'search' : lambda: SearchPlayer(p=1, rng=np.random.default_rng(seed), time_limit=None,
+                                               node_limit=search_nodes)}
+    if model is not None:
+        players['rnn'] = lambda: RNNPlayer(p=1, model=model, rng=np.random.default_rng(seed))
+    metrics = {}
+    for name, new_player in players.items():
+        if name == 'rnn':
+            batches = [np.zeros(shape=(1, mean_duration, board.n_positions), dtype=np.float32) for board in positions]
+            for batch, board in zip(batches, positions):
+                batch[0, -1] = board.grid.transpose().reshape(-1)
+            decide = lambda player: [player.move(board, batch) for board, batch in zip(positions, batches)]
+        else:
+            decide = lambda player: [player.move(board) for board in positions]
+        metrics[f'players.{name}.decisions_per_sec'] = len(positions) / best_time(decide, repeat, new_player)
+    return metrics
+
+#---------------------------------------------------------------------------------------------
+# whole simulations (serial and sharded) returning the raw arrays, with a fixed seed
+def bench_simulation(ns=(100, 1000), workers=(1, 2, 4), game_type='random-random', engine='grid', seed=0):
+    metrics = {}
+    for n in ns:
+        for w in workers:
+            elapsed = best_time(lambda: simulation(n, game_type, engine=engine, workers=w, seed=seed, as_arrays=True),
+                                repeat=1)
+            metrics[f'simulation.{game_type}.n{n}.workers{w}.games_per_sec'] = n / elapsed
+    return metrics
+
+#---------------------------------------------------------------------------------------------
+# df_to_tensor() throughput (moves per second) and peak memory of the NumPy part (traced by tracemalloc),
+# on a fixed simulated dataset
+def bench_dataset(n=2000, game_type='random-random', repeat=3, seed=0):
+    from tools.player_tools import df_to_tensor
+    df = simulation(n, game_type, workers=1, seed=seed)
+    elapsed = best_time(lambda: df_to_tensor(df), repeat)
+    tracemalloc.start()
+    df_to_tensor(df)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'dataset.df_to_tensor.moves_per_sec' : len(df) / elapsed,
+            'dataset.df_to_tensor.peak_bytes' : peak}
+
+# saving and loading the same dataset in the .json format of simulation() and in the binary .c4 format
+def bench_io(n=2000, game_type='random-random', repeat=3, seed=0):
+    from tools.dataset_tools import save_dataset, load_dataset
+    records = simulation(n, game_type, workers=1, seed=seed, as_arrays=True)
+    df = records_to_dataframe(records)
+    with tempfile.TemporaryDirectory() as folder:
+        json_path = os.path.join(folder, 'games.json')
+        binary_path = os.path.join(folder, 'games.c4')
+        metrics = {'io.json.save_sec' : best_time(lambda: df.reset_index().to_json(json_path), repeat),
+                   'io.json.load_sec' : best_time(lambda: read_json(json_path), repeat),
+                   'io.binary.save_sec' : best_time(lambda: save_dataset(binary_path, records), repeat),
+                   'io.binary.load_sec' : best_time(lambda: load_dataset(binary_path), repeat)}
+    return metrics
+
+benchmarks = {'board' : bench_board, 'players' : bench_players, 'simulation' : bench_simulation,
+              'dataset' : bench_dataset, 'io' : bench_io}
+
+# smaller sizes, for a quick check
+quick_settings = {'board' : {'n_games' : 300}, 'players' : {'n_positions' : 100},
+                  'simulation' : {'ns' : (100,), 'workers' : (1, 2)}, 'dataset' : {'n' : 300}, 'io' : {'n' : 300}}
+
+#---------------------------------------------------------------------------------------------
+def run_benchmarks(names=None, quick=False, model=None):
+    names = list(benchmarks) if names is None else names
+    results = {}
+    for name in names:
+        if name not in benchmarks:
+            raise ValueError(f'Unknown benchmark {name}, choose among {list(benchmarks)}.')
+        settings = dict(quick_settings[name]) if quick else {}
+        if name == 'players':
+            settings['model'] = model
+        start = time.perf_counter()
+        results.update(benchmarks[name](**settings))
+        print(f'{name}: done in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+    return {'info' : {'date' : time.strftime('%Y-%m-%d %H:%M:%S'), 'python' : platform.python_version(),
+                      'numpy' : np.__version__, 'platform' : platform.platform(), 'cpus' : os.cpu_count(),
+                      'quick' : quick},
+            'results' : results}
+
+# a metric regresses when it gets worse than the baseline by more than the threshold (relative change)
+def compare(results, baseline, threshold=0.1):
+    report = {}
+    for metric, value in results['results'].items():
+        if metric not in baseline['results']:
+            continue
+        reference = baseline['results'][metric]
+        change = (value - reference) / reference if reference else 0.0
+        # for the rates an increase is an improvement, for times and memory a decrease
+        higher_is_better = metric.endswith('_per_sec')
+        regression = (change < -threshold) if higher_is_better else (change > threshold)
+        report[metric] = {'value' : value, 'baseline' : reference, 'change' : change, 'regression' : regression}
+    return report
+
+def main(arguments=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmarks of the game engine, players and data pipeline.')
+    parser.add_argument('--only', nargs='+', choices=list(benchmarks), help='benchmarks to run (default: all)')
+    parser.add_argument('--quick', action='store_true', help='smaller sizes, for a quick check')
+    parser.add_argument('--model', help='model path (without extension) for the RNN player, NumPy backend')
+    parser.add_argument('--output', help='JSON file where the results are saved')
+    parser.add_argument('--baseline', help='JSON file of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change counted as a regression')
+    args = parser.parse_args(arguments)
+
+    model = None
+    if args.model is not None:
+        from tools.game_tools import load_model
+        model = load_model(args.model, backend='numpy')
+    results = run_benchmarks(args.only, args.quick, model)
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline is None:
+        print(json.dumps(results, indent=2))
+        return 0
+    with open(args.baseline, 'r') as file:
+        baseline = json.load(file)
+    report = compare(results, baseline, args.threshold)
+    for metric, row in report.items():
+        flag = 'REGRESSION' if row['regression'] else ''
+        print(f'{metric:55s} {row["value"]:14.4g} {row["baseline"]:14.4g} {100 * row["change"]:+7.1f}% {flag}')
+    regressions = [metric for metric, row in report.items() if row['regression']]
+    print(f'{len(regressions)} regressions out of {len(report)} metrics (threshold {100 * args.threshold:.0f}%).')
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
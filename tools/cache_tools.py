@@ -0,0 +1,113 @@
+import os
+import hashlib
+import numpy as np
+from collections import OrderedDict
+
+#---------------------------------------------------------------------------------------------
+# position cache for the neural player: the same early positions are visited millions of times during
+# the simulations, so their evaluation (the column probabilities of the RNNPlayer) is computed only once
+# (the SimplePlayer does not use it: hashing a board costs more than its vectorized check)
+# the key is a hash of the boards (a single board or a whole sequence, stored column by column as in the
+# game records), and the values are always the evaluation of exactly those boards, so the cache never
+# changes the moves of the player
+# with symmetric=True a position and its horizontal mirror share the same entry: the model is always run on
+# the canonical orientation and its output is mirrored back for the other one (the cached player becomes
+# the symmetrized version of the model, which is not mirror-equivariant by itself)
+class PositionCache(object):
+    def __init__(self, grid_size=(6,7), max_size=100_000, path=None, disk_slots=2**20, tag=None,
+                 symmetric=False):
+        self.height, self.width = grid_size
+        self.n_values = self.width          # one probability for each column
+        self.max_size = max_size            # maximum number of entries kept in memory (LRU)
+        self.symmetric = symmetric          # share the entries between mirrored positions
+        self.memory = OrderedDict()
+        # hit/miss statistics
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        # optional on-disk table, persisting across runs: a memory-mapped .npy file with a fixed number of
+        # slots, each position goes into the slot 1 + key % disk_slots (overwriting any previous entry)
+        # the first row stores the hash of the tag, which identifies what produced the values (e.g. the
+        # model path and its version): a file written with a different tag is rejected, so a retrained model
+        # never gets the probabilities of the previous one
+        self.path = path
+        self.tag = tag
+        self.disk = None
+        if path is not None:
+            if tag is None:
+                raise ValueError('A cache file needs a tag identifying the model, e.g. tag="models/1st_model:3".')
+            dtype = np.dtype([('key', '<u8'), ('values', '<f4', (self.n_values,))])
+            tag_key = self.hash(str(tag).encode())
+            if os.path.isfile(path):
+                self.disk = np.lib.format.open_memmap(path, mode='r+')
+                if self.disk.dtype != dtype:
+                    raise ValueError(f'The cache file {path} does not match the grid size.')
+                if self.disk['key'][0] != tag_key:
+                    raise ValueError(f'The cache file {path} was written with a different tag than {tag}.')
+            else:
+                self.disk = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(disk_slots + 1,))
+                self.disk['key'][0] = tag_key
+            self.disk_slots = len(self.disk) - 1
+
+    def mirror(self, boards):
+        shape = boards.shape
+        return boards.reshape(shape[:-1] + (self.width, self.height))[..., ::-1, :].reshape(shape)
+
+    # 64 bit hash, never 0 (the key of the empty slots)
+    def hash(self, data):
+        return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little') or 1
+
+    # returns the key and whether the boards have to be mirrored to get the canonical orientation
+    def key(self, boards):
+        boards = np.ascontiguousarray(boards, dtype=np.int8)
+        key = self.hash(boards.tobytes())
+        if not self.symmetric:
+            return key, False
+        mirrored_key = self.hash(np.ascontiguousarray(self.mirror(boards)).tobytes())
+        return (key, False) if key <= mirrored_key else (mirrored_key, True)
+
+    def mirror_values(self, values):
+        return values[::-1]
+
+    def lookup(self, key):
+        values = self.memory.get(key)
+        if values is not None:
+            self.memory.move_to_end(key)
+            self.hits += 1
+        elif (self.disk is not None) and (self.disk['key'][1 + key % self.disk_slots] == key):
+            values = np.array(self.disk['values'][1 + key % self.disk_slots])
+            self.remember(key, values)
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+        return values
+
+    # values of the boards, computed by function() only on a miss: the function always gets the canonical
+    # orientation, so the stored values do not depend on which orientation was evaluated first
+    def evaluate(self, boards, function):
+        key, flipped = self.key(boards)
+        values = self.lookup(key)
+        if values is None:
+            boards = self.mirror(np.asarray(boards)) if flipped else boards
+            values = np.asarray(function(boards), dtype=np.float32).reshape(self.n_values)
+            self.remember(key, values)
+            if self.disk is not None:
+                self.disk[1 + key % self.disk_slots] = (key, values)
+        return self.mirror_values(values) if flipped else values
+
+    def remember(self, key, values):
+        self.memory[key] = values
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def flush(self):
+        if self.disk is not None:
+            self.disk.flush()
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {'hits' : self.hits, 'disk_hits' : self.disk_hits, 'misses' : self.misses,
+                'hit_rate' : (self.hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+                'size' : len(self.memory)}
@@ -0,0 +1,265 @@
+import json
+import numpy as np
+import pandas as pd
+
+#---------------------------------------------------------------------------------------------
+# binary format for the simulated games, replacing the .json files inside the simulations folder
+# file layout:
+#   - 8 bytes magic string + 4 bytes (little endian) header length
+#   - json header with the format version, the grid size, the player names and, for each array,
+#     its byte offset, dtype and shape
+#   - the arrays, each one starting on a 64 bytes boundary:
+#       boards  (moves, height * width) int8, board states column by column (as in Game.save_game)
+#       choice  (moves,) int8
+#       player  (moves,) int8, indexes on the list of names
+#       move    (moves,) int16, move number inside the game
+#       offsets (games + 1,) int64, position of the first move of each game (plus the total)
+MAGIC = b'C4GAMES\x00'
+VERSION = 1
+ALIGNMENT = 64
+
+def _aligned(position):
+    return -(-position // ALIGNMENT) * ALIGNMENT
+
+# game offsets from the game index of each move (the moves of each game must be contiguous)
+def game_offsets(game):
+    starts = np.flatnonzero(np.diff(game)) + 1
+    return np.concatenate([[0], starts, [len(game)]]).astype(np.int64)
+
+# game index of each move, from the game offsets
+def game_index(offsets):
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+# records: the dictionary of arrays returned by simulation(as_arrays=True) or GameRecords.to_arrays()
+def save_dataset(path, records, grid_size=(6,7)):
+    arrays = {'boards' : np.ascontiguousarray(records['boards'], dtype=np.int8),
+              'choice' : np.ascontiguousarray(records['choice'], dtype=np.int8),
+              'player' : np.ascontiguousarray(records['player'], dtype=np.int8),
+              'move' : np.ascontiguousarray(records['move'], dtype=np.int16),
+              'offsets' : game_offsets(records['game'])}
+    header = {'version' : VERSION, 'grid_size' : list(grid_size), 'names' : list(records['names']),
+              'n_moves' : len(arrays['choice']), 'n_games' : len(arrays['offsets']) - 1, 'arrays' : {}}
+    # the header length depends on the offsets, which depend on the header length: the offsets are
+    # computed on a header with generous room for them, then the json text gets padded to that size
+    header['arrays'] = {key : [0, value.dtype.str, list(value.shape)] for key, value in arrays.items()}
+    header_size = _aligned(len(MAGIC) + 4 + len(json.dumps(header)) + 32 * len(arrays))
+    position = header_size
+    for key, value in arrays.items():
+        header['arrays'][key][0] = position
+        position = _aligned(position + value.nbytes)
+    text = json.dumps(header).encode()
+    text += b' ' * (header_size - len(MAGIC) - 4 - len(text))
+
+    with open(path, 'wb') as file:
+        file.write(MAGIC)
+        file.write(np.uint32(len(text)).tobytes())
+        file.write(text)
+        for key, value in arrays.items():
+            file.seek(header['arrays'][key][0])
+            file.write(value.tobytes())
+        file.truncate(position)
+
+# the whole file is memory-mapped and every array is a zero-copy view on it: nothing is actually
+# read from the disk until the data is used
+def load_dataset(path):
+    raw = np.memmap(path, dtype=np.uint8, mode='r')
+    if bytes(raw[:len(MAGIC)]) != MAGIC:
+        raise ValueError(f'{path} is not a simulation dataset file.')
+    length = int(raw[len(MAGIC):len(MAGIC) + 4].view('<u4')[0])
+    header = json.loads(bytes(raw[len(MAGIC) + 4:len(MAGIC) + 4 + length]))
+    if header['version'] > VERSION:
+        raise ValueError(f'Unsupported dataset version {header["version"]} (max {VERSION}).')
+    dataset = {'grid_size' : tuple(header['grid_size']), 'names' : header['names'], 'version' : header['version']}
+    for key, (offset, dtype, shape) in header['arrays'].items():
+        dtype = np.dtype(dtype)
+        n_bytes = int(np.prod(shape)) * dtype.itemsize
+        dataset[key] = raw[offset:offset + n_bytes].view(dtype).reshape(shape)
+    return dataset
+
+# arrays in the same form of simulation(as_arrays=True), e.g. to build the dataframe with records_to_dataframe()
+def dataset_to_records(dataset):
+    records = {key : dataset[key] for key in ['move', 'player', 'choice', 'boards', 'names']}
+    records['game'] = game_index(dataset['offsets'])
+    return records
+
+#---------------------------------------------------------------------------------------------
+# one-time conversion of the old .json datasets (as written by simulation(save_json=True))
+def dataframe_to_records(dataset):
+    # moves of the same game must be contiguous and ordered
+    df = dataset.sort_values('move', kind='stable')
+    df = df.iloc[np.argsort(df.index.to_numpy(), kind='stable')]
+    columns = [c for c in df.columns if c.startswith('col_')]
+    boards = np.array(df[columns].to_numpy().tolist(), dtype=np.int8)
+    codes, names = pd.factorize(df['player'])
+    return {'game' : pd.factorize(df.index)[0], 'move' : df['move'].to_numpy(), 'player' : codes,
+            'choice' : df['choice'].to_numpy(), 'boards' : boards.reshape(len(df), -1), 'names' : list(names)}, \
+           (boards.shape[2], boards.shape[1])
+
+def convert_json(path, output=None):
+    from tools.game_tools import read_json
+    records, grid_size = dataframe_to_records(read_json(path))
+    if output is None:
+        output = path[:-len('.json')] + '.c4' if path.endswith('.json') else path + '.c4'
+    save_dataset(output, records, grid_size)
+    return output
+
+#---------------------------------------------------------------------------------------------
+# vectorized version of the old row by row df_to_tensor pipeline: starting from the flat boards array and
+# the game offsets, it builds the (games, mean_duration, cells) features array in a single pass, keeping
+# the last mean_duration boards of each game and filling the shorter games with empty boards at the 
+# beginning; the target of each game is its last choice, i.e. the winning move
+def build_windows(boards, offsets, choice, mean_duration=None):
+    lengths = np.diff(offsets)
+    if mean_duration is None:
+        mean_duration = int(lengths.mean())
+    # position of each board inside the flat array, the ones before the start of the game are padding
+    index = offsets[1:, None] - mean_duration + np.arange(mean_duration)
+    valid = index >= offsets[:-1, None]
+    features = np.zeros(shape=(len(lengths), mean_duration, boards.shape[1]), dtype=np.int8)
+    features[valid] = boards[index[valid]]
+    targets = np.asarray(choice[offsets[1:] - 1], dtype=np.int64)
+    return features, targets, mean_duration
+
+#---------------------------------------------------------------------------------------------
+# training samples expansion: instead of the final move only, every move of the winning player becomes
+# a sample, whose features are the last mean_duration boards before that move
+# the boards get copied only once, adding (mean_duration - 1) empty boards before each game: after that,
+# the window ending on any board is just a slice of this padded array, so all the windows are strided
+# views on it (see windows_view()) and a sample is fully described by the start of its window
+def sample_windows(boards, offsets, choice, mean_duration=None, expand=True, mirror=False):
+    lengths = np.diff(offsets)
+    n_games = len(lengths)
+    if mean_duration is None:
+        mean_duration = int(lengths.mean())
+    shift = mean_duration - 1
+    # position of each board inside the padded array
+    game = np.repeat(np.arange(n_games), lengths)
+    position = np.arange(len(boards)) + shift * (game + 1)
+    padded = np.zeros(shape=(len(boards) + shift * n_games, boards.shape[1]), dtype=np.int8)
+    padded[position] = boards
+    if expand:
+        # the winner made the last move of the game, so its moves have the same parity
+        last = offsets[1:][game] - 1
+        moves = np.flatnonzero((last - np.arange(len(boards))) % 2 == 0)
+    else:
+        moves = offsets[1:] - 1
+    starts = position[moves] - shift
+    targets = np.asarray(choice[moves], dtype=np.int64)
+    flipped = np.zeros(len(moves), dtype=bool)
+    # horizontal mirror: same windows, flipped board and mirrored choice (handled by the pipeline)
+    if mirror:
+        starts = np.concatenate([starts, starts])
+        targets = np.concatenate([targets, targets])
+        flipped = np.concatenate([flipped, ~flipped])
+    return padded, starts, targets, flipped, mean_duration
+
+# all the (mean_duration, cells) windows of the padded array, as a view without any copy: the sample
+# windows are windows_view(padded, mean_duration)[starts]
+def windows_view(padded, mean_duration):
+    windows = np.lib.stride_tricks.sliding_window_view(padded, mean_duration, axis=0)
+    return windows.swapaxes(1, 2)
+
+# horizontal mirror of boards stored column by column: the columns order gets reversed (view)
+def mirror_boards(boards, grid_size=(6,7)):
+    height, width = grid_size
+    shape = boards.shape
+    return boards.reshape(shape[:-1] + (width, height))[..., ::-1, :].reshape(shape)
+
+# tf.data.Dataset with the same structure of df_to_tensor(): (mean_duration, cells) float64 sequences
+# with their int64 target; the features are kept as int8 and only converted inside the pipeline
+# with expand=True, each move of the winner is a sample (see sample_windows()), and with mirror=True
+# every sample is also added with the mirrored boards and the mirrored choice (width - 1 - choice)
+# the samples are gathered block by block from the strided view of the windows, so only the current
+# blocks get copied (plus the padded boards, once)
+def arrays_to_tensor(boards, offsets, choice, mean_duration=None, expand=False, mirror=False, grid_size=(6,7),
+                     block_size=256):
+    import tensorflow as tf
+    if not (expand or mirror):
+        features, targets, mean_duration = build_windows(boards, offsets, choice, mean_duration)
+        features = tf.data.Dataset.from_tensor_slices(features).map(lambda x: tf.cast(x, tf.float64))
+        targets = tf.data.Dataset.from_tensor_slices(targets)
+        return tf.data.Dataset.zip((features, targets))
+
+    height, width = grid_size
+    padded, starts, targets, flipped, mean_duration = sample_windows(boards, offsets, choice, mean_duration,
+                                                                     expand, mirror)
+    windows = windows_view(padded, mean_duration)
+    def read_samples(first):
+        block = slice(first, first + block_size)
+        features = windows[starts[block]]
+        target = targets[block].copy()
+        flip = flipped[block]
+        features[flip] = mirror_boards(features[flip], grid_size)
+        target[flip] = width - 1 - target[flip]
+        return features, target
+
+    def read(first):
+        features, target = tf.numpy_function(lambda f: read_samples(int(f)), [first], [tf.int8, tf.int64])
+        features.set_shape((None, mean_duration, width * height))
+        target.set_shape((None,))
+        return features, target
+    dataset = tf.data.Dataset.range(0, len(starts), block_size)
+    dataset = dataset.map(read, num_parallel_calls=tf.data.AUTOTUNE).unbatch()
+    return dataset.map(lambda x, y: (tf.cast(x, tf.float64), y), num_parallel_calls=tf.data.AUTOTUNE)
+
+#---------------------------------------------------------------------------------------------
+# streaming input pipeline: the games are read block by block from one or more dataset files (shards),
+# so the training set never needs to fit in memory; the windows are built on the fly, by a parallel
+# map over the blocks, and the shards are interleaved with each other
+def write_shards(records, prefix, games_per_shard=100_000, grid_size=(6,7)):
+    offsets = game_offsets(records['game'])
+    n_games = len(offsets) - 1
+    paths = []
+    for i, first in enumerate(range(0, n_games, games_per_shard)):
+        moves = slice(offsets[first], offsets[min(first + games_per_shard, n_games)])
+        shard = {key : records[key][moves] for key in ['game', 'move', 'player', 'choice', 'boards']}
+        shard['names'] = records['names']
+        paths.append(f'{prefix}_{i:04d}.c4')
+        save_dataset(paths[-1], shard, grid_size)
+    return paths
+
+# the memory-mapped shards are opened only once for each process
+_open_shards = {}
+def _shard(path):
+    if path not in _open_shards:
+        _open_shards[path] = load_dataset(path)
+    return _open_shards[path]
+
+def read_block(path, start, block_size, mean_duration):
+    dataset = _shard(path)
+    offsets = dataset['offsets'][start:start + block_size + 1]
+    features, targets, _ = build_windows(dataset['boards'], offsets, dataset['choice'], mean_duration)
+    return features, targets
+
+def stream_dataset(paths, mean_duration=None, block_size=256, cycle_length=4, num_parallel_calls=None,
+                   prefetch=True):
+    import glob
+    import tensorflow as tf
+    if isinstance(paths, str):
+        paths = sorted(glob.glob(paths))    # e.g. 'simulations/simulation_simple-simple_*.c4'
+    shards = [_shard(path) for path in paths]
+    n_games = [len(shard['offsets']) - 1 for shard in shards]
+    # same mean duration of build_windows(), computed on all the shards (only the offsets are read)
+    if mean_duration is None:
+        mean_duration = int(sum(int(shard['offsets'][-1]) for shard in shards) / sum(n_games))
+    cells = shards[0]['boards'].shape[1]
+    parallel = tf.data.AUTOTUNE if num_parallel_calls is None else num_parallel_calls
+
+    def read(path, start):
+        features, targets = tf.numpy_function(
+            lambda p, s: read_block(p.decode(), int(s), block_size, mean_duration), [path, start], [tf.int8, tf.int64])
+        features.set_shape((None, mean_duration, cells))
+        targets.set_shape((None,))
+        return features, targets
+
+    def blocks(path, games):
+        starts = tf.data.Dataset.range(0, games, block_size)
+        return starts.map(lambda start: read(path, start), num_parallel_calls=parallel).unbatch()
+
+    dataset = tf.data.Dataset.from_tensor_slices((paths, tf.constant(n_games, dtype=tf.int64)))
+    dataset = dataset.interleave(blocks, cycle_length=cycle_length, num_parallel_calls=parallel)
+    # same structure of df_to_tensor() and arrays_to_tensor()
+    dataset = dataset.map(lambda x, y: (tf.cast(x, tf.float64), y), num_parallel_calls=parallel)
+    if prefetch:
+        dataset = dataset.prefetch(tf.data.AUTOTUNE)
+    return dataset
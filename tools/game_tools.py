@@ -1,10 +1,57 @@
+import os
 import numpy as np
 import pandas as pd
 from tools.player_tools import *
+from tools.profile_tools import Profiler
 
-#---------------------------------------------------------------------------------------------        
+#---------------------------------------------------------------------------------------------
+# the winner check only needs to look at the n-cells windows passing through the last token placed:
+# the next function builds (once for each grid size and line length) the table of all the windows, as
+# flat indexes on the grid and following the same order used by Board.initialize_vectors(), along with
+# the list of windows containing each cell (at most 13 on a 6x7 board with n=4)
+# the tables are shared by all the boards with the same geometry
+# the column of each window cell and the group of each window (0 for rows, 1 for columns and 2 for
+# diagonals) are used by the SimplePlayer to find the lines that are about to be completed
+_window_tables = {}
+def window_tables(grid_size=(6,7), n_connect=4):
+    key = (tuple(grid_size), n_connect)
+    if key not in _window_tables:
+        height, width = grid_size
+        n = n_connect
+        cells = np.arange(height * width).reshape(grid_size)
+        windows = []
+        # rows, columns and then diagonals/anti-diagonals, as in the vectors list
+        for j in range(width - n + 1):
+            for i in range(height):
+                windows.append(cells[i, j:j+n])
+        for j in range(height - n + 1):
+            for i in range(width):
+                windows.append(cells.T[i, j:j+n])
+        for j in range(width - n + 1):
+            for i in range(height - n + 1):
+                sub_grid = cells[i:i+n, j:j+n]
+                windows.append(np.diagonal(sub_grid))
+                windows.append(np.flipud(sub_grid).diagonal())
+        windows = np.array(windows, dtype=np.int64).reshape(-1, n)
+        cell_windows = [np.flatnonzero((windows == cell).any(axis=1)) for cell in range(height * width)]
+        rows_number = max(width - n + 1, 0) * height
+        cols_number = width * max(height - n + 1, 0)
+        groups = np.zeros(len(windows), dtype=np.int64) + 2
+        groups[:rows_number] = 0
+        groups[rows_number:(rows_number + cols_number)] = 1
+        _window_tables[key] = {'windows' : windows, 'cell_windows' : cell_windows,
+                               'columns' : windows % width, 'groups' : groups}
+    return _window_tables[key]
+
+# the line length must fit inside the grid in at least one direction
+def check_geometry(grid_size, n_connect):
+    if (n_connect < 2) or (n_connect > max(grid_size)):
+        raise ValueError(f'Lines of {n_connect} tokens are not possible on a {grid_size[0]}x{grid_size[1]} grid.')
+    return n_connect
+
+#---------------------------------------------------------------------------------------------
 class Board(object):
-    def __init__(self, grid_size=(6,7)):
+    def __init__(self, grid_size=(6,7), n_connect=4):
         # winner checking: 1 for player1, -1 for player 2 and 0 for "tie"
         self.winner = 0
 
@@ -12,6 +59,7 @@ class Board(object):
         self.height = grid_size[0]
         self.width = grid_size[1]
         self.n_positions = self.height * self.width # number of initial positions
+        self.n_connect = check_geometry(grid_size, n_connect)   # tokens in a row needed to win
 
         # how many positions are left for each column
         self.column_n_pos = np.zeros(self.width, dtype=np.int16) + self.height
@@ -20,11 +68,23 @@ class Board(object):
 
         # initializing functions
         self.initialize_grids(grid_size)
-        self.initialize_vectors()
+        self._vectors = None
+
+        # windows tables used by the winner check and the last filled cell (flat index on the grid)
+        self.initialize_tables(grid_size)
+        self.last_cell = None
+
+    def initialize_tables(self, grid_size):
+        tables = window_tables(grid_size, self.n_connect)
+        self.windows = tables['windows']
+        self.cell_windows = tables['cell_windows']
+        self.window_columns = tables['columns']
+        self.window_groups = tables['groups']
 
     # function for initializing the grids used to keep track of the various positions
     def initialize_grids(self, grid_size):
         self.grid = np.zeros(shape=grid_size)                   # main grid
+        self.flat_grid = self.grid.reshape(-1)                  # flat view of the main grid
         self.valid_grid = np.zeros_like(self.grid, dtype=bool)  # grid for valid moves
         # initialize the whole first row as valid
         self.valid_grid[-1] = True
@@ -33,64 +93,73 @@ class Board(object):
     
     # function for initializing vectors that will be used later for the update process
     # these vectors contain basically all the needed information about the grid state
+    # they are only built if some player actually asks for them (see the properties below): the winner
+    # check and the players use the window tables, shared by all the boards with the same geometry
     def initialize_vectors(self):
-        self.vectors = []           # used to check if the winning condition is satisfied
-        self.valid_vectors = []     # used to let the player make a valid move during the game
-        self.column_vectors = []    # used to gather the information about the columns' state during the game
+        n = self.n_connect
+        vectors = []            # used to check if the winning condition is satisfied
+        valid_vectors = []      # used to let the player make a valid move during the game
+        column_vectors = []     # used to gather the information about the columns' state during the game
 
-        # to check for a winner, the next loop goes through the whole grid looking for a filled "Connect4"
+        # to check for a winner, the next loop goes through the whole grid looking for a filled line of n cells
         # the view() method is only used to generate a new view of the arrays using the same data
-        for j in range(self.width - 3): # exclude the last 3 columns
+        for j in range(self.width - n + 1): # exclude the last n-1 columns
             for i, sub_row in enumerate(self.grid):
-                # view the next 4 cells 
-                grid_view = self.grid[i][j:j+4].view()   
-                valid_view = self.valid_grid[i][j:j+4].view()
-                column_view = self.column_grid[i][j:j+4].view()
-        
-                self.vectors.append(grid_view)
-                self.valid_vectors.append(valid_view)
-                self.column_vectors.append(column_view)
+                # view the next n cells
+                vectors.append(self.grid[i][j:j+n].view())
+                valid_vectors.append(self.valid_grid[i][j:j+n].view())
+                column_vectors.append(self.column_grid[i][j:j+n].view())
 
-        # the column views are very similar to the previous ones, with the exception that we are using the 
+        # the column views are very similar to the previous ones, with the exception that we are using the
         # transpose of the previous grid
         t_grid = self.grid.transpose()
         t_valid_grid = self.valid_grid.transpose()
         t_column_grid = self.column_grid.transpose()
 
-        for j in range(self.height - 3): # exclude the last 3 rows
+        for j in range(self.height - n + 1): # exclude the last n-1 rows
             for i, sub_col in enumerate(t_grid):
-                # view the next 4 cells 
-                grid_view = t_grid[i][j:j+4].view()   
-                valid_view = t_valid_grid[i][j:j+4].view()
-                column_view = t_column_grid[i][j:j+4].view()
-        
-                self.vectors.append(grid_view)
-                self.valid_vectors.append(valid_view)
-                self.column_vectors.append(column_view)
+                vectors.append(t_grid[i][j:j+n].view())
+                valid_vectors.append(t_valid_grid[i][j:j+n].view())
+                column_vectors.append(t_column_grid[i][j:j+n].view())
 
-        # diagonal views are a bit different: we firstly divide the grids into smaller 4x4 sub-grids
+        # diagonal views are a bit different: we firstly divide the grids into smaller nxn sub-grids
         # then, using numpy's diagonal and flip methods, we take both the diagonal and the anti-diagonal
         # of these sub-grids
-        for j in range(self.width - 3):
-            for i in range(self.height - 3):
-                sub_grid = self.grid[i:i+4, j:j+4]
-                sub_valid_grid = self.valid_grid[i:i+4, j:j+4]
-                sub_column_grid = self.column_grid[i:i+4, j:j+4]
-
-                grid_diag = np.diagonal(sub_grid).view()
-                grid_adiag = np.flipud(sub_grid).diagonal().view()
-                valid_grid_diag = np.diagonal(sub_valid_grid).view()
-                valid_grid_adiag = np.flipud(sub_valid_grid).diagonal().view()
-                column_grid_diag = np.diagonal(sub_column_grid).view()
-                column_grid_adiag = np.flipud(sub_column_grid).diagonal().view()
-
-                self.vectors.append(grid_diag)
-                self.vectors.append(grid_adiag)
-                self.valid_vectors.append(valid_grid_diag)
-                self.valid_vectors.append(valid_grid_adiag)
-                self.column_vectors.append(column_grid_diag)
-                self.column_vectors.append(column_grid_adiag)
-                
+        for j in range(self.width - n + 1):
+            for i in range(self.height - n + 1):
+                for grid, views in [(self.grid, vectors), (self.valid_grid, valid_vectors),
+                                    (self.column_grid, column_vectors)]:
+                    sub_grid = grid[i:i+n, j:j+n]
+                    views.append(np.diagonal(sub_grid).view())
+                    views.append(np.flipud(sub_grid).diagonal().view())
+
+        self._vectors = vectors
+        self._valid_vectors = valid_vectors
+        self._column_vectors = column_vectors
+
+    # the vectors are views on the grids, so they stay valid even if they get built in the middle of a game
+    @property
+    def vectors(self):
+        if self._vectors is None:
+            self.initialize_vectors()
+        return self._vectors
+
+    @vectors.setter
+    def vectors(self, value):
+        self._vectors = value
+
+    @property
+    def valid_vectors(self):
+        if self._vectors is None:
+            self.initialize_vectors()
+        return self._valid_vectors
+
+    @property
+    def column_vectors(self):
+        if self._vectors is None:
+            self.initialize_vectors()
+        return self._column_vectors
+
     #---------------------------------------------------------------------------------------------
     # function used to update the grid state, based on a Player's choice (the column to place the token in)
     def update_grid(self, Player):
@@ -106,6 +175,7 @@ class Board(object):
         
         # update values in the main grid and the boolean one, using the player's marker (-1 or +1)
         self.grid[row,choice] = Player.marker
+        self.last_cell = row * self.width + choice
         self.valid_grid[row,choice] = False
         # the cell on top of the token becomes available
         if (row != 0):  # the last top row 
@@ -128,12 +198,16 @@ class Board(object):
 
     
     def check_winner(self, Player):
-        win = False
-        for vector in self.vectors:
-            if sum(vector) == Player.target:
-                self.winner = Player.marker
-                win = True
-                break
+        # a new line can only pass through the cell filled by the player's last move: in that case we sum 
+        # just the windows containing it, otherwise (e.g. the last token belongs to the opponent) we go
+        # through all of them
+        if (self.last_cell is not None) and (self.flat_grid[self.last_cell] == Player.marker):
+            windows = self.windows[self.cell_windows[self.last_cell]]
+        else:
+            windows = self.windows
+        win = bool((self.flat_grid[windows].sum(axis=1) == self.n_connect * Player.marker).any())
+        if win:
+            self.winner = Player.marker
         return win
     
     def display_grid(self):
@@ -165,67 +239,206 @@ class Board(object):
             txt += str(i) + '     '
         print(txt)
 
+#---------------------------------------------------------------------------------------------
+# lowest bits of the runs of n set bits along the direction of the shift: the length of the runs doubles
+# at each step (1, 2, 4, ...), so a line of 4 takes two shifts as in the classic Connect4 bitboard
+def bit_lines(mask, shift, n):
+    length = 1
+    while length < n:
+        step = min(length, n - length)
+        mask &= mask >> (step * shift)
+        length += step
+    return mask
+
+# compact alternative to the Board class: the whole game state is stored inside two integer bitmasks 
+# (one for each player) plus the number of positions left in each column, so that a move is just a 
+# bitwise OR and the winner check is a handful of shift-and-mask operations instead of 69 sums
+# bit layout: each column takes (height + 1) bits, filled from the bottom row upwards, the extra bit on
+# top of every column is always empty and avoids false alignments between adjacent columns
+class BitBoard(Board):
+    def __init__(self, grid_size=(6,7), n_connect=4):
+        # the vectors are only built if some player actually asks for them (see the Board properties)
+        self._vectors = None
+        self.winner = 0
+
+        # grid parameters
+        self.height = grid_size[0]
+        self.width = grid_size[1]
+        self.n_positions = self.height * self.width
+        self.n_connect = check_geometry(grid_size, n_connect)
+        self.stride = self.height + 1   # number of bits used by each column
+
+        self.column_n_pos = np.zeros(self.width, dtype=np.int16) + self.height
+        self.n_pos_left = self.n_positions
+
+        # one bitmask for each player: index 0 for the +1 marker, index 1 for the -1 marker
+        self.masks = [0, 0]
+        # the grids are still kept up to date (one cell per move), since the game recording, 
+        # the display and the players read the board state from them
+        self.initialize_grids(grid_size)
+        self.initialize_tables(grid_size)
+
+    #---------------------------------------------------------------------------------------------
+    def update_grid(self, Player):
+        choice = Player.choice
+        # first check: is there place for an additional token in that column?
+        if (choice < 0) | (choice >= self.width) or self.column_n_pos[choice] == 0:
+            print(f'Error: this column number {choice} has no more valid positions!')
+            return -1
+        if self.n_pos_left <= 0:
+            print('Error : there are no positions left!')
+            return -1
+
+        row = self.column_n_pos[choice] - 1
+        # the bit index counts the tokens from the bottom of the column
+        bit = choice * self.stride + (self.height - 1 - row)
+        self.masks[(1 - Player.marker) // 2] |= 1 << int(bit)
+
+        self.grid[row,choice] = Player.marker
+        self.valid_grid[row,choice] = False
+        if (row != 0):
+            self.valid_grid[row-1,choice] = True
+
+        self.column_n_pos[choice] -= 1
+        self.n_pos_left -= 1
+
+    def check_winner(self, Player):
+        mask = self.masks[(1 - Player.marker) // 2]
+        # shifts for the vertical, horizontal, diagonal and anti-diagonal directions
+        for shift in (1, self.stride, self.stride - 1, self.stride + 1):
+            if bit_lines(mask, shift, self.n_connect):
+                self.winner = Player.marker
+                return True
+        return False
+
+# the two engines must always agree: this function plays n random games on both of them, using the
+# same moves, and compares the grids, the positions left and the winner check after every single move
+def check_engines(n=1000, grid_size=(6,7), seed=None, n_connect=4):
+    rng = np.random.default_rng(seed)
+    players = [RandomPlayer(p=1), RandomPlayer(p=-1)]
+    for game in range(n):
+        boards = [Board(grid_size, n_connect), BitBoard(grid_size, n_connect)]
+        win = False
+        while (not win) & (boards[0].n_pos_left > 0):
+            for player in players:
+                valid_columns = np.flatnonzero(boards[0].column_n_pos)
+                player.choice = int(rng.choice(valid_columns))
+                states = [board.update_grid(player) for board in boards]
+                wins = [[board.check_winner(p) for p in players] for board in boards]
+                if ((states[0] != states[1]) | (wins[0] != wins[1]) | (boards[0].n_pos_left != boards[1].n_pos_left)
+                    or not np.array_equal(boards[0].grid, boards[1].grid)
+                    or not np.array_equal(boards[0].column_n_pos, boards[1].column_n_pos)):
+                    print(f'Error: the engines disagree in game #{game}, after the move in column {player.choice}!')
+                    return False
+                win = any(wins[0])
+                if win | (boards[0].n_pos_left == 0):
+                    break
+    return True
+
 #---------------------------------------------------------------------------------------------       
 import math
-from IPython.display import clear_output
+
+# board engines available to the Game class
+engines = {'grid' : Board, 'bitboard' : BitBoard}
 
 class Game(object):
     def __init__(self, game_type=None, verbose=False, pause=False, player1=None, player2=None, 
-                 model=tf.keras.Sequential()):
+                 model=None, engine='grid', rng=None, search_time=0.5, caches=None, players=None, profiler=None,
+                 grid_size=(6,7), n_connect=4, node_limit=None):
         self.verbose = verbose              # shows the grid during the game
+        self.profiler = profiler            # optional Profiler (see profile_tools.py) timing the phases of the game
         self.pause = pause                  # used when playing against AI to visualize its moves      
         self.flag = False                   # used to break the loop at the end of the game
-        self.Board = Board()                # generate the board and all the useful vectors
+        if engine not in engines:
+            raise ValueError(f'Unknown board engine {engine}, choose one of {list(engines)}.')
+        self.Board = engines[engine](grid_size, n_connect)  # generate the board (n_connect tokens in a row to win)
+        self.rng = np.random if rng is None else rng    # random numbers source, shared with the players
         
         self.game_record = {'player' : [], 
                             'choice' : [],  # dictionary used to save the game
                             'grid' : []}
 
-        if game_type=='user-user':
-            p1 = HumanPlayer(name=player1, p=1)
-            p2 = HumanPlayer(name=player2, p=-1)
+        # already built players (e.g. from arena_tools.py), playing in the given order
+        if players is not None:
+            p1, p2 = players
+
+        elif game_type=='user-user':
+            p1 = HumanPlayer(name=player1, p=1, rng=self.rng)
+            p2 = HumanPlayer(name=player2, p=-1, rng=self.rng)
 
         elif game_type=='user-random':
-            p1 = HumanPlayer(name=player1, p=1)
-            p2 = RandomPlayer(name=player2, p=-1)
+            p1 = HumanPlayer(name=player1, p=1, rng=self.rng)
+            p2 = RandomPlayer(name=player2, p=-1, rng=self.rng)
 
         elif game_type=='user-simple':
-            p1 = HumanPlayer(name=player1, p=1)
-            p2 = SimplePlayer(name=player2, p=-1)
+            p1 = HumanPlayer(name=player1, p=1, rng=self.rng)
+            p2 = SimplePlayer(name=player2, p=-1, rng=self.rng)
         
         elif game_type=='user-rnn':
-            p1 = HumanPlayer(name=player1, p=1)
-            p2 = RNNPlayer(name=player2, p=-1, model=model)
+            p1 = HumanPlayer(name=player1, p=1, rng=self.rng)
+            p2 = RNNPlayer(name=player2, p=-1, model=model, rng=self.rng)
 
         elif game_type=='random-random':
-            p1 = RandomPlayer(name=player1, p=1)
-            p2 = RandomPlayer(name=player2, p=-1)
+            p1 = RandomPlayer(name=player1, p=1, rng=self.rng)
+            p2 = RandomPlayer(name=player2, p=-1, rng=self.rng)
 
         elif game_type=='simple-random':
-            p1 = SimplePlayer(name=player1, p=1)
-            p2 = RandomPlayer(name=player2, p=-1)
+            p1 = SimplePlayer(name=player1, p=1, rng=self.rng)
+            p2 = RandomPlayer(name=player2, p=-1, rng=self.rng)
         
         elif game_type=='simple-simple':
-            p1 = SimplePlayer(name=player1, p=1)
-            p2 = SimplePlayer(name=player2, p=-1)
+            p1 = SimplePlayer(name=player1, p=1, rng=self.rng)
+            p2 = SimplePlayer(name=player2, p=-1, rng=self.rng)
 
         elif game_type=='rnn-random':
-            p1 = RNNPlayer(name=player1, p=1, model=model)
-            p2 = RandomPlayer(name=player2, p=-1)
+            p1 = RNNPlayer(name=player1, p=1, model=model, rng=self.rng)
+            p2 = RandomPlayer(name=player2, p=-1, rng=self.rng)
 
         elif game_type=='rnn-simple':
-            p1 = RNNPlayer(name=player1, p=1, model=model)
-            p2 = SimplePlayer(name=player2, p=-1)
+            p1 = RNNPlayer(name=player1, p=1, model=model, rng=self.rng)
+            p2 = SimplePlayer(name=player2, p=-1, rng=self.rng)
+
+        # the search player gets search_time seconds (and at most node_limit nodes) for each move
+        elif game_type=='user-search':
+            p1 = HumanPlayer(name=player1, p=1, rng=self.rng)
+            p2 = SearchPlayer(name=player2, p=-1, rng=self.rng, time_limit=search_time, node_limit=node_limit)
+
+        elif game_type=='search-random':
+            p1 = SearchPlayer(name=player1, p=1, rng=self.rng, time_limit=search_time, node_limit=node_limit)
+            p2 = RandomPlayer(name=player2, p=-1, rng=self.rng)
+
+        elif game_type=='search-simple':
+            p1 = SearchPlayer(name=player1, p=1, rng=self.rng, time_limit=search_time, node_limit=node_limit)
+            p2 = SimplePlayer(name=player2, p=-1, rng=self.rng)
+
+        elif game_type=='search-search':
+            p1 = SearchPlayer(name=player1, p=1, rng=self.rng, time_limit=search_time, node_limit=node_limit)
+            p2 = SearchPlayer(name=player2, p=-1, rng=self.rng, time_limit=search_time, node_limit=node_limit)
+
+        elif game_type=='rnn-search':
+            p1 = RNNPlayer(name=player1, p=1, model=model, rng=self.rng)
+            p2 = SearchPlayer(name=player2, p=-1, rng=self.rng, time_limit=search_time, node_limit=node_limit)
+
+        # position caches (see cache_tools.py) for the players that support them (only the neural one), e.g.
+        # caches={'RecurrentAI' : PositionCache()}
+        if caches is not None:
+            for player_type in caches:
+                if player_type != 'RecurrentAI':
+                    raise ValueError(f'Only the RecurrentAI players support a position cache, not {player_type}.')
+            for player in [p1, p2]:
+                if player.player_type in caches:
+                    player.cache = caches[player.player_type]
 
         if p1.name == None:
             p1.name = f'{p1.player_type}_1'
         if p2.name == None:
             p2.name = f'{p2.player_type}_2'
             
-        # the starting player is always chosen at random 
+        # the starting player is chosen at random, unless the players were given
         self.player_list = [p1, p2]
         self.player_types = [p1.player_type, p2.player_type]
-        np.random.shuffle(self.player_list)
+        if players is None:
+            self.rng.shuffle(self.player_list)
 
         if self.verbose:
             print(f'Game Type: {game_type}')
@@ -235,27 +448,47 @@ class Game(object):
     # this function runs through a game of Connect4 by first asking the player for a move, then updating the grid and,
     # finally, checking for a winner (eventually, it stops when reaching the total number of possible moves)
     def play_game(self, record=True, mean_duration=21):
+        profiler = self.profiler
+        if profiler is not None:
+            game_start = profiler.start()
         self.move_counter = 0
-        # initialize the batch to make the prediction on
-        batch_np = np.zeros(shape=(32, mean_duration, self.Board.height * self.Board.width))
-        # the sequence is the board states sequence that gets updated during the game
-        sequence = batch_np[0]
+        height, width = self.Board.height, self.Board.width
+        # the board states sequence is kept inside a ring buffer, written in place: after a move is written
+        # in row `head`, the window (oldest board first) is the single gather ring[ring_order[head]] and it
+        # gets copied into the (1, mean_duration, cells) input of the model only when a neural player moves
+        neural = 'RecurrentAI' in self.player_types
+        if neural:
+            ring = np.zeros(shape=(mean_duration, height * width), dtype=np.float32)
+            ring_order = (np.arange(mean_duration)[:, None] + np.arange(1, mean_duration + 1)) % mean_duration
+            window = np.zeros(shape=(1, mean_duration, height * width), dtype=np.float32)
+            head = -1
+        # the boards of the game (column by column, as in the records) are written in a preallocated array
+        if record:
+            self.boards = np.zeros(shape=(self.Board.n_positions, height * width), dtype=np.int8)
         for _ in range(math.ceil(self.Board.n_positions / 2)):   # main loop, one iteration per move by both players
             for player in self.player_list:
                 self.move_counter += 1
-                # generate the batch tensor only if one of the player is a neural network
-                if 'RecurrentAI' in self.player_types:
-                    board = np.concatenate(self.Board.grid.transpose()) # 42 elements from the original grid
-                    sequence = np.vstack([sequence, board])[1:]         # we update the sequence with the last move,
-                                                                        # removing the first one
-                    batch_np[-1] = sequence                             # update the last sequence
-                    batch = tf.convert_to_tensor(batch_np)
+                # update the sequence only if one of the player is a neural network
+                if neural:
+                    if profiler is not None:
+                        start = profiler.start()
+                    head = (head + 1) % mean_duration
+                    np.copyto(ring[head].reshape(width, height), self.Board.grid.transpose())
+                    if player.player_type == 'RecurrentAI':
+                        np.take(ring, ring_order[head], axis=0, out=window[0])
+                    if profiler is not None:
+                        profiler.stop('game/sequence', start)
 
                 # we save the grid before the grid update, so that the choice in the final dataset will
                 # correspond to the choice made on that particular grid
                 if record:
-                    self.game_record['grid'].append((self.Board.grid.transpose()).tolist())
+                    if profiler is not None:
+                        start = profiler.start()
+                    np.copyto(self.boards[self.move_counter - 1].reshape(width, height), self.Board.grid.transpose(),
+                              casting='unsafe')
                     self.game_record['player'].append(player.name)
+                    if profiler is not None:
+                        profiler.stop('game/record', start)
                 # the board state (from the Board.update_grid() function) returns -1 if the player
                 # makes an invalid move
                 board_state = -1
@@ -264,15 +497,27 @@ class Game(object):
                         print(f'Turn #{self.move_counter}: rock to {player.name}!')
                         print('+----------------------------------------------------------------+')
                         self.Board.display_grid()
+                        from IPython.display import clear_output   # only needed in the notebooks
                         clear_output(wait=True)
                         if (self.pause) & (player.player_type != 'Human') : input()
+                    if profiler is not None:
+                        start = profiler.start()
                     if player.player_type == 'RecurrentAI':
-                        player.move(self.Board, batch)
+                        player.move(self.Board, window)
                     else: player.move(self.Board)
+                    if profiler is not None:
+                        profiler.stop(f'game/move:{player.player_type}', start)
+                        start = profiler.start()
                     board_state = self.Board.update_grid(player)
+                    if profiler is not None:
+                        profiler.stop('game/update_grid', start)
                 if record:
                     self.game_record['choice'].append(player.choice)
+                if profiler is not None:
+                    start = profiler.start()
                 self.win = self.Board.check_winner(player)      # check if the game has a winner
+                if profiler is not None:
+                    profiler.stop('game/check_winner', start)
                 if self.win:
                     if self.verbose:
                         print(f'The WINNER is {player.name}, {player.player_type}!!!')
@@ -284,60 +529,239 @@ class Game(object):
             # check if there are no positions left
             if (self.win) | (self.Board.n_pos_left == 0):
                 break
+        # the grids of the record are a (moves, width, height) view on the boards array
+        if record:
+            self.game_record['grid'] = self.boards[:self.move_counter].reshape(-1, width, height)
+        if profiler is not None:
+            profiler.stop('game', game_start)
+            profiler.count('moves', self.move_counter)
+            profiler.count('games' if self.win else 'draws')
         
     def save_game(self):
-        df = pd.DataFrame(self.game_record)
-        columns = [f'col_{i}' for i in range(self.Board.width)]
-        df[columns] = pd.DataFrame(df['grid'].tolist(), index=df.index)
-        df.drop(columns='grid', inplace=True)
+        df = pd.DataFrame({'player' : self.game_record['player'], 'choice' : self.game_record['choice']})
+        grids = np.asarray(self.game_record['grid'], dtype=float)
+        for i in range(self.Board.width):
+            df[f'col_{i}'] = grids[:, i].tolist()
         return df
     
 #---------------------------------------------------------------------------------------------
-from tqdm import tqdm
+#---------------------------------------------------------------------------------------------
+# the games are stored inside a preallocated columnar buffer, instead of concatenating one dataframe for
+# each game: the board states (int8, one row of 42 cells for each move), the choices, the players and the
+# game/move indexes are kept in separate arrays, whose capacity gets doubled only when they are full
+class GameRecords(object):
+    def __init__(self, n_cells=42, capacity=1024):
+        self.n_cells = n_cells
+        self.size = 0                   # number of moves stored
+        self.n_games = 0                # number of games stored
+        self.names = []                 # player names, the player column contains their indexes
+        self.boards = np.zeros(shape=(capacity, n_cells), dtype=np.int8)
+        self.choice = np.zeros(capacity, dtype=np.int8)
+        self.player = np.zeros(capacity, dtype=np.int8)
+        self.move = np.zeros(capacity, dtype=np.int16)
+        self.game = np.zeros(capacity, dtype=np.int64)
+
+    # makes room for (at least) a given number of moves, keeping the stored ones
+    def reserve(self, size):
+        capacity = len(self.choice)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for key in ['boards', 'choice', 'player', 'move', 'game']:
+            old = getattr(self, key)
+            new = np.zeros(shape=(capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, key, new)
+
+    def player_code(self, name):
+        if name not in self.names:
+            self.names.append(name)
+        return self.names.index(name)
+
+    # stores a game played with Game.play_game(record=True)
+    def add_game(self, game):
+        record = game.game_record
+        moves = len(record['choice'])
+        self.reserve(self.size + moves)
+        new = slice(self.size, self.size + moves)
+        self.boards[new] = game.boards[:moves]
+        self.choice[new] = record['choice']
+        self.player[new] = [self.player_code(name) for name in record['player']]
+        self.move[new] = np.arange(moves)
+        self.game[new] = self.n_games
+        self.size += moves
+        self.n_games += 1
+
+    # stores the games contained in the arrays returned by to_arrays(), numbering them after the 
+    # games already stored
+    def add_records(self, records):
+        moves = len(records['choice'])
+        self.reserve(self.size + moves)
+        new = slice(self.size, self.size + moves)
+        codes = np.array([self.player_code(name) for name in records['names']], dtype=np.int8)
+        self.boards[new] = records['boards']
+        self.choice[new] = records['choice']
+        self.player[new] = codes[records['player']]
+        self.move[new] = records['move']
+        self.game[new] = records['game'] + self.n_games
+        self.size += moves
+        self.n_games += len(np.unique(records['game']))
+
+    # the arrays are just views on the used part of the buffers
+    def to_arrays(self):
+        return {'game' : self.game[:self.size], 'move' : self.move[:self.size], 
+                'player' : self.player[:self.size], 'choice' : self.choice[:self.size],
+                'boards' : self.boards[:self.size], 'names' : list(self.names)}
+
+    def to_dataframe(self, grid_size=(6,7)):
+        return records_to_dataframe(self.to_arrays(), grid_size)
+
+# builds the same dataframe returned by simulation() from the arrays of a set of games, indexed by game
+def records_to_dataframe(records, grid_size=(6,7)):
+    height, width = grid_size
+    df = pd.DataFrame({'player' : np.array(records['names'])[records['player']],
+                       'move' : records['move'].astype(np.int64),
+                       'choice' : records['choice'].astype(np.int64)},
+                      index=records['game'])
+    boards = records['boards'].reshape(-1, width, height).astype(float)
+    for i in range(width):
+        df[f'col_{i}'] = boards[:, i].tolist()
+    return df
+
+#---------------------------------------------------------------------------------------------
 # simulating N AI-AI games
-def simulation(n=100, game_type='random-random', model=tf.keras.Sequential(), 
-               mean_duration=21, save_json=False, name=None):
-    dataset = pd.DataFrame()
-    i = 0
-    if n <= 1000:
-        for i in tqdm(range(n), desc='Simulating', bar_format='{l_bar}{bar:15}{r_bar}{bar:-10b}'):
-            game = Game(game_type=game_type, model=model)  # initialize the game environment
-            game.play_game(mean_duration=mean_duration)    # play the game
-            # repeat if the game ends in a draw
-            while not game.win: 
-                game = Game(game_type=game_type, model=model)
-                game.play_game(mean_duration=mean_duration)                   
-            game = game.save_game()        
-            game['move'] = game.index 
-            game.index = [i] * len(game)
-            dataset = pd.concat([dataset, game])
+def simulation(n=100, game_type='random-random', model=None, 
+               mean_duration=21, save_json=False, name=None, engine='grid', workers=None, seed=None,
+               as_arrays=False, save_binary=False, caches=None, profiler=None, grid_size=(6,7), n_connect=4,
+               search_time=0.5, node_limit=None):
+    # the position caches (caches=) are only used by the serial path (no seed, workers or batch engine):
+    # each worker process would get its own copy of them
+    if (caches is not None) and ((engine == 'batch') or (workers is not None) or (seed is not None)):
+        raise ValueError('The position caches can only be used by the serial simulation, without seed, workers '
+                         'and batch engine.')
+    if engine == 'batch':
+        # all the games are played together by the vectorized engine
+        from tools.batch_tools import batch_simulation
+        records = batch_simulation(n, game_type=game_type, model=model, mean_duration=mean_duration, seed=seed,
+                                   as_arrays=True, grid_size=grid_size, n_connect=n_connect)
+    elif (workers is not None) or (seed is not None):
+        # sharded simulation: the same (seed, workers) pair always gives the same dataset
+        records = sharded_simulation(n, game_type, model, mean_duration, engine, workers=workers or 1, seed=seed,
+                                     profiler=profiler, grid_size=grid_size, n_connect=n_connect,
+                                     search_time=search_time, node_limit=node_limit)
     else:
-        j = 0
-        for _ in tqdm(range(int(n / 1000)), desc='Simulating', bar_format='{l_bar}{bar:15}{r_bar}{bar:-10b}'):
-            df = pd.DataFrame()
-            for i in range(1000):
-                game = Game(game_type=game_type, model=model)
-                game.play_game(mean_duration=mean_duration)
-                while not game.win:
-                    game = Game(game_type=game_type, model=model)
-                    game.play_game(mean_duration=mean_duration)       
-                game = game.save_game()
-                game['move'] = game.index
-                game.index = [i + j] * len(game)
-                df = pd.concat([df, game])
-            j += i + 1
-            dataset = pd.concat([dataset, df])
+        records = simulate_shard(n, game_type, model, mean_duration, engine, progress=True, caches=caches,
+                                 profiler=profiler, grid_size=grid_size, n_connect=n_connect,
+                                 search_time=search_time, node_limit=node_limit)
+    # compact binary format (see dataset_tools.py), memory-mapped by load_dataset()
+    if save_binary:
+        from tools.dataset_tools import save_dataset
+        if profiler is not None:
+            start = profiler.start()
+        save_dataset(f'simulations/simulation_{game_type}_{n}.c4' if name == None else f'{name}.c4', records,
+                     grid_size)
+        if profiler is not None:
+            profiler.stop('save_binary', start)
+    # the dataframe is built only once, at the end, and only if needed
+    if as_arrays and not save_json:
+        return records
+    if profiler is not None:
+        start = profiler.start()
+    dataset = records_to_dataframe(records, grid_size)
+    if profiler is not None:
+        profiler.stop('dataframe', start)
     # I decided to save the dataframe into .json format in order to preserve the dtype inside the dataframe,
     # since most of the values are arrays that get converted to strings using the default pd.to_csv() function
     if save_json:
         print('Saving: ...')
+        if profiler is not None:
+            start = profiler.start()
         # rearrange the columns order
         if name == None:
             dataset.reset_index().to_json(f'simulations/simulation_{game_type}_{n}.json')
         else:
             dataset.reset_index().to_json(f'{name}.json')
+        if profiler is not None:
+            profiler.stop('save_json', start)
         #dataset.to_csv(f'simulations/simulation_{game_type}_{n}.csv')
-    return dataset[['player', 'move', 'choice', 'col_0', 'col_1', 'col_2', 'col_3', 'col_4', 'col_5', 'col_6']]
+    if as_arrays:
+        return records
+    return dataset[['player', 'move', 'choice'] + [f'col_{i}' for i in range(grid_size[1])]]
+
+#---------------------------------------------------------------------------------------------
+# the next functions split the n games into one shard per worker: each shard is played with its own
+# random generator (the seeds are spawned from the main one) and returns its games as a few compact
+# arrays (boards, moves, players, choices and game index) instead of a pickled dataframe
+# without a seed, the games use the global np.random state (this is the serial path of simulation())
+def simulate_shard(n, game_type='random-random', model=None, mean_duration=21, engine='grid', seed=None,
+                   progress=False, caches=None, profiler=None, grid_size=(6,7), n_connect=4, search_time=0.5,
+                   node_limit=None):
+    rng = None if seed is None else np.random.default_rng(seed)
+    records = GameRecords(n_cells=grid_size[0] * grid_size[1])
+    games = range(n)
+    if progress:
+        from tqdm import tqdm
+        games = tqdm(games, desc='Simulating', bar_format='{l_bar}{bar:15}{r_bar}{bar:-10b}')
+    for _ in games:
+        game = Game(game_type=game_type, model=model, engine=engine, rng=rng, caches=caches,  # initialize the game
+                    profiler=profiler, grid_size=grid_size, n_connect=n_connect, search_time=search_time,
+                    node_limit=node_limit)
+        game.play_game(mean_duration=mean_duration)                                         # play the game
+        # repeat if the game ends in a draw
+        while not game.win: 
+            game = Game(game_type=game_type, model=model, engine=engine, rng=rng, caches=caches, profiler=profiler,
+                        grid_size=grid_size, n_connect=n_connect, search_time=search_time, node_limit=node_limit)
+            game.play_game(mean_duration=mean_duration)
+        if profiler is not None:
+            start = profiler.start()
+        records.add_game(game)
+        if profiler is not None:
+            profiler.stop('records', start)
+    return records.to_arrays()
+
+# each worker fills its own profiler, sent back as a dictionary together with the games
+def _simulate_shard(args):
+    *args, profile, grid_size, n_connect, search_time, node_limit = args
+    profiler = Profiler() if profile else None
+    records = simulate_shard(*args, profiler=profiler, grid_size=grid_size, n_connect=n_connect,
+                             search_time=search_time, node_limit=node_limit)
+    return records, None if profiler is None else profiler.to_dict()
+
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+def sharded_simulation(n=100, game_type='random-random', model=None, mean_duration=21, engine='grid',
+                       workers=1, seed=None, profiler=None, grid_size=(6,7), n_connect=4, search_time=0.5,
+                       node_limit=None):
+    # the model is only sent to the workers if a neural player is involved
+    if 'rnn' not in game_type:
+        model = None
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+    sizes = [len(shard) for shard in np.array_split(np.arange(n), workers)]
+    shards = [(size, game_type, model, mean_duration, engine, s, profiler is not None, grid_size, n_connect,
+               search_time, node_limit) for size, s in zip(sizes, seeds) if size > 0]
+    if workers == 1:
+        chunks = [_simulate_shard(shard) for shard in shards]
+    else:
+        from tqdm import tqdm
+        # the workers are started with 'spawn': a process forked from one where TensorFlow is already running
+        # (e.g. a notebook with a Keras model) can hang forever as soon as it calls the model
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn')) as executor:
+            chunks = list(tqdm(executor.map(_simulate_shard, shards), total=len(shards), desc='Simulating',
+                               bar_format='{l_bar}{bar:15}{r_bar}{bar:-10b}'))
+    if profiler is not None:
+        for _, profile in chunks:
+            profiler.merge(profile)
+        start = profiler.start()
+    # merging the chunks: the game index continues from one shard to the next one, and the player
+    # indexes refer to a single list of names
+    records = GameRecords(n_cells=grid_size[0] * grid_size[1],
+                          capacity=max(sum(len(chunk['choice']) for chunk, _ in chunks), 1))
+    for chunk, _ in chunks:
+        records.add_records(chunk)
+    if profiler is not None:
+        profiler.stop('merge', start)
+    return records.to_arrays()
 
 #---------------------------------------------------------------------------------------------
 def read_json(path):
@@ -355,10 +779,40 @@ def save_model(model, path=''): # path example: 'folder/name' - without extensio
         json_file.write(model_json)
     # serialize weights to HDF5
     model.save_weights(f'{path}.h5')
+    # the fast versions saved by load_model() belong to the previous weights
+    if os.path.isfile(f'{path}.npz'):
+        os.remove(f'{path}.npz')
+    if os.path.isdir(f'{path}_traced'):
+        import shutil
+        shutil.rmtree(f'{path}_traced')
     print('Model saved succesfully.')
+
+# a fast version of the model saved by load_model() is only used if it is newer than the model files
+def is_fresh(cache, path):
+    sources = [f'{path}.json', f'{path}.h5']
+    return os.path.exists(cache) and all(os.path.getmtime(cache) >= os.path.getmtime(source)
+                                         for source in sources if os.path.exists(source))
  
-from keras.models import model_from_json
-def load_model(path):
+# backend: 'keras' (the plain Keras model), 'traced' (graph traced once with a fixed input signature and
+# saved next to the model files) or 'numpy' (pure NumPy forward pass, see inference_tools.py)
+def load_model(path, backend='keras', mean_duration=21):
+    if backend not in ['keras', 'traced', 'numpy']:
+        raise ValueError(f'Backend {backend} is not supported, choose among keras, traced and numpy.')
+    from tools.inference_tools import TracedModel, NumpyModel
+    # warm start: the NumPy weights saved by a previous run do not need TensorFlow at all
+    if (backend == 'numpy') and is_fresh(f'{path}.npz', path):
+        print('Model succesfully loaded.')
+        return NumpyModel.load(f'{path}.npz')
+    # the traced graph is rebuilt if it was saved for a different sequence length
+    if (backend == 'traced') and is_fresh(f'{path}_traced/saved_model.pb', path):
+        try:
+            traced_model = TracedModel(mean_duration=mean_duration, path=f'{path}_traced')
+            print('Model succesfully loaded.')
+            return traced_model
+        except ValueError:
+            pass
+    # Keras is only imported here, so the game engine can be used without it
+    from keras.models import model_from_json
     # load json and create model
     json_file = open(f'{path}.json', 'r')
     loaded_model_json = json_file.read()
@@ -367,4 +821,11 @@ def load_model(path):
     # load weights into new model
     loaded_model.load_weights(f'{path}.h5')
     print('Model succesfully loaded.')
+    if backend == 'traced':
+        n_cells = loaded_model.input_shape[-1]
+        return TracedModel(loaded_model, mean_duration, n_cells, path=f'{path}_traced')
+    if backend == 'numpy':
+        numpy_model = NumpyModel.from_keras(loaded_model)
+        numpy_model.save(f'{path}.npz')
+        return numpy_model
     return loaded_model
\ No newline at end of file
@@ -0,0 +1,206 @@
+import os
+import numpy as np
+
+#---------------------------------------------------------------------------------------------
+# fast inference for the RNNPlayer: Keras' predict() has a large fixed cost for every call, which
+# dominates when the model is asked for a single move at a time
+# the first option traces the model once into a tf.function with a fixed input signature
+# (batch, mean_duration, cells), optionally saved as a SavedModel next to the model files, so that
+# later runs can load the traced graph directly
+class TracedModel(object):
+    def __init__(self, model=None, mean_duration=21, n_cells=42, path=None):
+        import tensorflow as tf
+        self.tf = tf
+        self.mean_duration = mean_duration
+        if model is None:
+            # warm start: the graph was traced and saved by a previous run, with the same sequence length
+            # (the input signature is fixed)
+            if (path is None) or not os.path.isdir(path):
+                raise ValueError('A model or the path of a saved traced model is needed.')
+            self.module = tf.saved_model.load(path)
+            saved_duration = getattr(self.module, 'mean_duration', None)
+            if (saved_duration is None) or (int(saved_duration.numpy()) != mean_duration):
+                raise ValueError(f'The traced model in {path} does not take sequences of {mean_duration} boards.')
+        else:
+            signature = [tf.TensorSpec(shape=(None, mean_duration, n_cells), dtype=tf.float32)]
+            self.module = tf.Module()
+            self.module.model = model
+            self.module.mean_duration = tf.Variable(mean_duration, trainable=False)
+            self.module.serve = tf.function(lambda x: model(x, training=False), input_signature=signature)
+            if path is not None:
+                tf.saved_model.save(self.module, path)
+        self.serve = self.module.serve
+
+    # same interface of the Keras models used by the RNNPlayer
+    def predict(self, x, verbose=0):
+        return self.serve(self.tf.cast(x, self.tf.float32)).numpy()
+
+    def __call__(self, x, training=False):
+        return self.serve(self.tf.cast(x, self.tf.float32))
+
+#---------------------------------------------------------------------------------------------
+# the second option is a pure NumPy forward pass of the conv-recurrent layers used in the project
+# (Conv1D, BatchNormalization, LSTM/GRU/SimpleRNN, Dense): no TensorFlow call at all for a move
+# the weights can be saved into a .npz file next to the model, and loaded back without TensorFlow
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+def hard_sigmoid(x):
+    return np.clip(0.2 * x + 0.5, 0, 1)
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+activations = {'linear' : lambda x: x, 'relu' : lambda x: np.maximum(x, 0), 'tanh' : np.tanh,
+               'sigmoid' : sigmoid, 'hard_sigmoid' : hard_sigmoid, 'softmax' : softmax}
+
+def activation(name):
+    if name not in activations:
+        raise ValueError(f'Activation {name} is not supported by the NumPy forward pass.')
+    return activations[name]
+
+def conv1d(x, layer):
+    kernel = layer['weights'][0]
+    bias = 0 if layer['bias'] is None else layer['bias']
+    size, stride = kernel.shape[0], layer['strides']
+    if layer['padding'] == 'causal':
+        x = np.pad(x, ((0, 0), (size - 1, 0), (0, 0)))
+    elif layer['padding'] != 'valid':
+        raise ValueError(f'Padding {layer["padding"]} is not supported by the NumPy forward pass.')
+    windows = np.lib.stride_tricks.sliding_window_view(x, size, axis=1)[:, ::stride]   # (batch, steps, in, size)
+    return activation(layer['activation'])(np.einsum('btck,kco->bto', windows, kernel) + bias)
+
+def batch_normalization(x, layer):
+    gamma, beta, mean, variance = layer['weights']
+    return (x - mean) / np.sqrt(variance + layer['epsilon']) * gamma + beta
+
+def dense(x, layer):
+    bias = 0 if layer['bias'] is None else layer['bias']
+    return activation(layer['activation'])(x @ layer['weights'][0] + bias)
+
+def recurrent(x, layer):
+    kernel, recurrent_kernel = layer['weights'][:2]
+    units = recurrent_kernel.shape[0]
+    act = activation(layer['activation'])
+    rec_act = activation(layer.get('recurrent_activation', 'sigmoid'))
+    h = np.zeros(shape=(x.shape[0], units), dtype=x.dtype)
+    c = np.zeros_like(h)
+    # the input projection of all the steps at once, only the recurrent part is sequential
+    inputs = x @ kernel
+    bias = layer['bias']
+    if (bias is not None) and (bias.ndim == 1):
+        inputs = inputs + bias
+    outputs = []
+    for t in range(x.shape[1]):
+        if layer['type'] == 'LSTM':
+            z = inputs[:, t] + h @ recurrent_kernel
+            i, f, g, o = np.split(z, 4, axis=-1)
+            c = rec_act(f) * c + rec_act(i) * act(g)
+            h = rec_act(o) * act(c)
+        elif layer['type'] == 'GRU':
+            two_biases = (bias is not None) and (bias.ndim == 2)
+            x_z, x_r, x_h = np.split(inputs[:, t] + (bias[0] if two_biases else 0), 3, axis=-1)
+            if layer['reset_after']:
+                # Keras' default: the reset gate is applied after the recurrent kernel
+                h_z, h_r, h_h = np.split(h @ recurrent_kernel + (bias[1] if two_biases else 0), 3, axis=-1)
+                z = rec_act(x_z + h_z)
+                r = rec_act(x_r + h_r)
+                h = z * h + (1 - z) * act(x_h + r * h_h)
+            else:
+                u_z, u_r, u_h = np.split(recurrent_kernel, 3, axis=-1)
+                z = rec_act(x_z + h @ u_z)
+                r = rec_act(x_r + h @ u_r)
+                h = z * h + (1 - z) * act(x_h + (r * h) @ u_h)
+        else:
+            h = act(inputs[:, t] + h @ recurrent_kernel)
+        outputs.append(h)
+    return np.stack(outputs, axis=1) if layer['return_sequences'] else h
+
+forward = {'Conv1D' : conv1d, 'BatchNormalization' : batch_normalization, 'Dense' : dense,
+           'LSTM' : recurrent, 'GRU' : recurrent, 'SimpleRNN' : recurrent}
+
+class NumpyModel(object):
+    def __init__(self, layers, version=None):
+        self.layers = layers
+        self.version = version
+
+    @classmethod
+    def from_keras(cls, model):
+        layers = []
+        for keras_layer in model.layers:
+            kind = keras_layer.__class__.__name__
+            if kind in ['InputLayer', 'Dropout']:
+                continue
+            if kind not in forward:
+                raise ValueError(f'Layer {kind} is not supported by the NumPy forward pass.')
+            config = keras_layer.get_config()
+            weights = [np.asarray(w, dtype=np.float32) for w in keras_layer.get_weights()]
+            layer = {'type' : kind, 'activation' : config.get('activation', 'linear'),
+                     'recurrent_activation' : config.get('recurrent_activation', 'sigmoid'),
+                     'return_sequences' : config.get('return_sequences', False),
+                     'reset_after' : config.get('reset_after', True), 'padding' : config.get('padding', 'valid'),
+                     'epsilon' : config.get('epsilon', 1e-3)}
+            layer['bias'] = None
+            if kind == 'BatchNormalization':
+                # missing scale/center weights are replaced by ones and zeros
+                if not config.get('scale', True):
+                    weights.insert(0, np.ones_like(weights[-1]))
+                if not config.get('center', True):
+                    weights.insert(1, np.zeros_like(weights[-1]))
+            else:
+                # kernel (plus the recurrent kernel for the recurrent layers), then the optional bias
+                n_kernels = 2 if kind in ['LSTM', 'GRU', 'SimpleRNN'] else 1
+                if len(weights) > n_kernels:
+                    layer['bias'] = weights[n_kernels]
+                weights = weights[:n_kernels]
+            if kind == 'Conv1D':
+                strides = config['strides']
+                layer['strides'] = strides[0] if isinstance(strides, (list, tuple)) else strides
+                if config.get('dilation_rate', 1) not in [1, (1,), [1]]:
+                    raise ValueError('Dilated convolutions are not supported by the NumPy forward pass.')
+            layer['weights'] = weights
+            layers.append(layer)
+        return cls(layers)
+
+    def predict(self, x, verbose=0):
+        x = np.asarray(x, dtype=np.float32)
+        for layer in self.layers:
+            x = forward[layer['type']](x, layer)
+        return x
+
+    def __call__(self, x, training=False):
+        return self.predict(x)
+
+    # the layers are saved as plain arrays inside a .npz file, together with their settings (and the
+    # optional version of the weights, used by the self-play workers to know which checkpoint they play)
+    def save(self, path, version=None):
+        arrays = {}
+        if version is not None:
+            arrays['version'] = np.array(version)
+        for i, layer in enumerate(self.layers):
+            for j, weights in enumerate(layer['weights']):
+                arrays[f'{i}_weights_{j}'] = weights
+            if layer['bias'] is not None:
+                arrays[f'{i}_bias'] = layer['bias']
+            settings = {key : value for key, value in layer.items() if key not in ['weights', 'bias']}
+            arrays[f'{i}_settings'] = np.array(repr(settings))
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        import ast
+        data = np.load(path)
+        layers = []
+        i = 0
+        while f'{i}_settings' in data:
+            layer = ast.literal_eval(str(data[f'{i}_settings']))
+            j = 0
+            layer['weights'] = []
+            while f'{i}_weights_{j}' in data:
+                layer['weights'].append(data[f'{i}_weights_{j}'])
+                j += 1
+            layer['bias'] = data[f'{i}_bias'] if f'{i}_bias' in data else None
+            layers.append(layer)
+            i += 1
+        return cls(layers, int(data['version']) if 'version' in data else None)
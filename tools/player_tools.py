@@ -1,162 +1,328 @@
+import time
 import numpy as np
 import pandas as pd
-import tensorflow as tf
 #---------------------------------------------------------------------------------------------
 class Player(object):
-    def __init__(self, p=1, name='Player1'):
+    def __init__(self, p=1, name='Player1', rng=None):
         self.player = p                     # number ID to produce the grid markers
         self.name = name                    # the name is used only for displaying purposes and to avoid misunderstandings
+        # random numbers source: the global numpy state by default, or a np.random.Generator
+        self.rng = np.random if rng is None else rng
         if self.player == 1:
             self.marker = 1
         else:
             self.marker = -1
-        self.target = int(4 * self.marker)  # +4 for player 1 and -4 for player 2
 
 #---------------------------------------------------------------------------------------------       
 class HumanPlayer(Player):
-    def __init__(self, p=1, name='Human'):
-        Player.__init__(self, p, name)
+    def __init__(self, p=1, name='Human', rng=None):
+        Player.__init__(self, p, name, rng)
         self.player_type = 'Human'
 
     def move(self, Board):
         self.choice = int(input('Digit a column number to place your token.'))
         
 class RandomPlayer(Player):
-    def __init__(self, p=1, name='Random'):
-        Player.__init__(self, p, name)
+    def __init__(self, p=1, name='Random', rng=None):
+        Player.__init__(self, p, name, rng)
         self.player_type = 'RandomAI'
 
     def move(self, Board):
         # columns with available moves
         valid_columns = [i for i, v in enumerate(Board.column_n_pos) if v != 0]
-        self.choice = np.random.choice(valid_columns)
+        self.choice = self.rng.choice(valid_columns)
 
 class SimplePlayer(Player):
-    def __init__(self, p=1, name='Simple'):
-        Player.__init__(self, p, name)
+    def __init__(self, p=1, name='Simple', rng=None):
+        Player.__init__(self, p, name, rng)
         self.player_type = 'SimpleAI'
 
     def move(self, Board):
         # columns with available moves
         valid_columns = [i for i, v in enumerate(Board.column_n_pos) if v != 0]
         # first of all, it guesses at random 
-        # then, using the following algorithm, it checks for rows, columns or diagonals that
-        # may lead to victory or defeat and fills the column where there is still a 0
-        rows_number = (Board.width - 3) * Board.height  # number of checking rows
-        cols_number = Board.width * (Board.height - 3)  # number of checking columns
-        # below we write, respectively, the checking rows, columns and diagonals vectors stored
-        # inside the board class
-        rows = Board.vectors[:rows_number]
-        cols = Board.vectors[rows_number:(rows_number + cols_number)]
-        diags = Board.vectors[(rows_number + cols_number):]
-        # now we want to identify the column of each element inside these vectors
-        # to do so, we use an equation explained in the markdown file
-        if self.target == 4:
-            target = 3
-        else:
-            target = -3
-
-        column = -1 # initialize the column to a non-valid value
-        for i, vector in enumerate([rows, cols, diags]):
-            targets = np.array([sum(v) for v in vector])           # sum of each vector (row, col, or diag) 
-            vector_index = np.where(targets == -(target))          # list of indexes where the vector can be completed
-            if len(vector_index[0]) > 0:
-                index = np.where(vector[vector_index[0][0]] == 0)  # index of the 0 inside the vector
-                if i == 0:
-                    column = int(vector_index[0][0] / Board.height) + index[0][0]
-                if i == 1:
-                    column = vector_index[0][0] % Board.width
-                if i == 2:
-                    column = int(int(vector_index[0][0] / 2) / (Board.height - 3)) + index[0][0]
-                break
-            # the same thing can happen for a winning move: by putting it after the defeat scenario,
-            # we give priority to winning moves
-            vector_index = np.where(targets == target)
-            if len(vector_index[0]) > 0:
-                index = np.where(vector[vector_index[0][0]] == 0)
-                if i == 0:
-                    column = int(vector_index[0][0] / Board.height) + index[0][0]
-                if i == 1:
-                    column = vector_index[0][0] % Board.width
-                if i == 2:
-                    column = int(int(vector_index[0][0] / 2) / (Board.height - 3)) + index[0][0]
-                break
+        # then it checks for rows, columns or diagonals that may lead to victory or defeat and fills the 
+        # column where there is still a 0 (no position cache here: hashing the board costs more than the
+        # vectorized check itself)
+        column = self.threat_column(Board)
 
         if column in valid_columns:
             self.choice = column
         else:
-            self.choice = np.random.choice(valid_columns)
+            self.choice = self.rng.choice(valid_columns)
+
+    # all the windows are gathered at once from the flat grid, using the tables stored inside the board
+    # (flat index, column and group of each window); it returns -1 if no window can be completed
+    def threat_column(self, Board):
+        target = (Board.n_connect - 1) * self.marker    # +3 for player 1 and -3 for player 2 in Connect4
+        cells = Board.flat_grid[Board.windows]
+        sums = cells.sum(axis=1)
+        # the first group (rows, then columns, then diagonals) with a window that can be completed decides
+        # the move; inside the group, the defeat scenario comes first, so we give priority to winning moves
+        groups = Board.window_groups
+        keys = np.where(sums == -target, 2 * groups, np.where(sums == target, 2 * groups + 1, 6))
+
+        column = -1 # initialize the column to a non-valid value
+        if keys.min() < 6:
+            window = np.argmin(keys)                            # first window with the lowest key
+            column = int(Board.window_columns[window][cells[window] == 0][0])
+        return column
 
 class RNNPlayer(Player):
-    def __init__(self, p=1, name='RNN', model=tf.keras.Sequential()):
-        Player.__init__(self, p, name)
+    def __init__(self, p=1, name='RNN', model=None, rng=None, cache=None):
+        Player.__init__(self, p, name, rng)
         self.player_type = 'RecurrentAI'
+        if model is None:
+            # TensorFlow is only imported when a neural player is actually created
+            import tensorflow as tf
+            model = tf.keras.Sequential()
         self.model = model
+        self.cache = cache                  # optional PositionCache, see cache_tools.py
     
-    def move(self, Board, batch):  # note that we use the entire batch to make the predictions
+    def move(self, Board, batch):  # only the last sequence of the batch is used for the prediction
         valid_columns = [i for i, v in enumerate(Board.column_n_pos) if v != 0]
-        # column probabilities on the current sequence
-        probas = self.model.predict(batch, verbose=0)[-1:][0]
+        # column probabilities on the current sequence (the key of the cache is the whole sequence)
+        if self.cache is None:
+            probas = self.model.predict(batch[-1:], verbose=0)[0]
+        else:
+            probas = self.cache.evaluate(np.asarray(batch[-1]),
+                                         lambda sequence: self.model.predict(sequence[None], verbose=0)[0])
         # sort in descending order the probas array and get the index list
         choices = np.argsort(-probas)
         # take the first element of the list that is also in the valid_columns list
         self.choice = choices[np.isin(choices, valid_columns)][0] 
 
-from tqdm import tqdm
-#---------------------------------------------------------------------------------------------       
-pd.options.mode.chained_assignment = None  # default='warn'
-def padding(dataset):
-    df = pd.DataFrame()
-    # getting the mean duration of each game
-    mean_duration = int(dataset['grid'].groupby(dataset.index).count().mean())
-    # creating the padding row: it's just an empty board with a random choice
-    padding_row = dataset[:1]
-    padding_row['grid'] = [np.zeros(shape=dataset['grid'].iloc[0].shape)]
-    padding_row['choice'] = np.int64(0)
-    # now, for each sequence shorter than mean_duration, we append (mean_duration - len(sequence)) 
-    # padding rows at the beginning of the sequence
-    def append_rows(sequence):
-        difference = abs(mean_duration - len(sequence))
-        if difference > 0:
-            # repeating padding rows
-            padding_rows = pd.DataFrame(np.repeat(padding_row.values, difference, axis=0),
-                                        index=[sequence.index[0]]*difference, columns=sequence.columns)
-            return pd.concat([padding_rows, sequence])
+#---------------------------------------------------------------------------------------------
+# negamax search with alpha-beta pruning, working on a bitboard copy of the board (see the BitBoard
+# class in game_tools.py): 'position' contains the tokens of the player to move, 'mask' all the tokens
+# a win is worth more the sooner it happens, the positions at the search horizon are evaluated by the
+# difference between the empty cells that would complete a line for each player
+class SearchTimeout(Exception):
+    pass
+
+# fixed-size transposition table: each position key (position + mask, unique for each position) goes
+# into the slot key % size, and a stored entry is replaced only by a search that is at least as deep
+# or by any search of a later move (the older entries are less likely to be useful)
+class TranspositionTable(object):
+    EXACT, LOWER, UPPER = 0, 1, 2
+
+    def __init__(self, size=2**20):
+        self.size = size
+        self.entries = [None] * size    # (key, depth, flag, value, move, age)
+        self.age = 0
+
+    def get(self, key):
+        entry = self.entries[key % self.size]
+        if (entry is not None) and (entry[0] == key):
+            return entry
+        return None
+
+    def put(self, key, depth, flag, value, move):
+        index = key % self.size
+        entry = self.entries[index]
+        if (entry is None) or (entry[5] != self.age) or (depth >= entry[1]):
+            self.entries[index] = (key, depth, flag, value, move, self.age)
+
+class SearchPlayer(Player):
+    def __init__(self, p=1, name='Search', rng=None, time_limit=0.5, node_limit=None, max_depth=None, 
+                 table_size=2**20):
+        Player.__init__(self, p, name, rng)
+        self.player_type = 'SearchAI'
+        self.time_limit = time_limit        # seconds for each move (None for no limit)
+        self.node_limit = node_limit        # searched positions for each move (None for no limit)
+        self.max_depth = max_depth          # None: up to the end of the game
+        self.table = TranspositionTable(table_size)
+        self.geometry = None
+        # search statistics of the last move
+        self.nodes = 0
+        self.depth = 0
+        self.nps = 0
+
+    # bitboard masks, built once for each grid size and line length
+    def initialize_geometry(self, height, width, n_connect=4):
+        self.geometry = (height, width, n_connect)
+        self.height = height
+        self.width = width
+        self.n_connect = n_connect
+        self.stride = height + 1
+        self.n_positions = height * width
+        self.bottom = [1 << (c * self.stride) for c in range(width)]
+        self.top = [1 << (c * self.stride + height - 1) for c in range(width)]
+        self.column_mask = [((1 << height) - 1) << (c * self.stride) for c in range(width)]
+        self.board_mask = sum(self.column_mask)
+        # center-first move ordering
+        self.order = sorted(range(width), key=lambda c: (abs(2 * c - (width - 1)), c))
+        # the win scores (win_score - moves) are always above the heuristic ones (at most n_positions)
+        self.win_score = 2 * self.n_positions + 1
+
+    def to_bitboard(self, Board):
+        if self.geometry != (Board.height, Board.width, Board.n_connect):
+            self.initialize_geometry(Board.height, Board.width, Board.n_connect)
+        if hasattr(Board, 'masks'):
+            own = Board.masks[(1 - self.marker) // 2]
+            mask = Board.masks[0] | Board.masks[1]
+            return own, mask
+        own, mask = 0, 0
+        for (row, col), value in np.ndenumerate(Board.grid):
+            if value != 0:
+                bit = 1 << (col * self.stride + self.height - 1 - row)
+                mask |= bit
+                if value == self.marker:
+                    own |= bit
+        return own, mask
+
+    # n tokens in a row: the length of the runs of set bits doubles at each step (see bit_lines() in game_tools.py)
+    def alignment(self, position):
+        n = self.n_connect
+        for shift in (1, self.stride, self.stride - 1, self.stride + 1):
+            lines, length = position, 1
+            while length < n:
+                step = min(length, n - length)
+                lines &= lines >> (step * shift)
+                length += step
+            if lines:
+                return True
+        return False
+
+    # empty cells that would complete a line of the given player: for each direction, the cells with k
+    # tokens on one side and n-1-k on the other one (only the tokens below, for the vertical lines)
+    def winning_cells(self, position, mask):
+        n = self.n_connect
+        cells = -1
+        for i in range(1, n):
+            cells &= position << i
+        for shift in (self.stride, self.stride - 1, self.stride + 1):
+            before, after = [-1], [-1]
+            for i in range(1, n):
+                before.append(before[-1] & (position << (i * shift)))
+                after.append(after[-1] & (position >> (i * shift)))
+            for k in range(n):
+                cells |= before[k] & after[n - 1 - k]
+        return cells & (self.board_mask ^ mask)
+
+    def evaluate(self, position, mask):
+        return (self.winning_cells(position, mask).bit_count() 
+                - self.winning_cells(position ^ mask, mask).bit_count())
+
+    def negamax(self, position, mask, moves, depth, alpha, beta):
+        self.nodes += 1
+        if (self.nodes & 1023) == 0:
+            if (self.deadline is not None) and (time.perf_counter() > self.deadline):
+                raise SearchTimeout()
+        if (self.node_limit is not None) and (self.nodes > self.node_limit):
+            raise SearchTimeout()
+
+        playable = [c for c in self.order if not (mask & self.top[c])]
+        # a winning move ends the search immediately
+        for c in playable:
+            if self.alignment(position | ((mask + self.bottom[c]) & self.column_mask[c])):
+                return self.win_score - moves
+        if moves + 1 >= self.n_positions:
+            return 0
+        if depth == 0:
+            return self.evaluate(position, mask)
+
+        key = position + mask
+        alpha_start = alpha
+        entry = self.table.get(key)
+        best_move = None
+        if entry is not None:
+            best_move = entry[4]
+            if entry[1] >= depth:
+                if entry[2] == TranspositionTable.EXACT:
+                    return entry[3]
+                if entry[2] == TranspositionTable.LOWER:
+                    alpha = max(alpha, entry[3])
+                else:
+                    beta = min(beta, entry[3])
+                if alpha >= beta:
+                    return entry[3]
+        # the best move of a previous search is tried first
+        if best_move in playable:
+            playable.remove(best_move)
+            playable.insert(0, best_move)
+
+        value = -self.win_score - 1
+        for c in playable:
+            score = -self.negamax(position ^ mask, mask | (mask + self.bottom[c]), moves + 1, depth - 1, -beta, -alpha)
+            if score > value:
+                value, best_move = score, c
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+
+        if value <= alpha_start:
+            flag = TranspositionTable.UPPER
+        elif value >= beta:
+            flag = TranspositionTable.LOWER
         else:
-            return sequence
-    df = dataset.groupby(dataset.index).apply(append_rows).droplevel(0)
-    return df, mean_duration
+            flag = TranspositionTable.EXACT
+        self.table.put(key, depth, flag, value, best_move)
+        return value
+
+    # iterative deepening: the search goes one move deeper at a time, until the time or node budget runs
+    # out; the move of the last completed depth is played
+    def move(self, Board):
+        position, mask = self.to_bitboard(Board)
+        moves = mask.bit_count()
+        start = time.perf_counter()
+        self.deadline = None if self.time_limit is None else start + self.time_limit
+        self.table.age += 1
+        self.nodes = 0
+        max_depth = self.n_positions - moves
+        if self.max_depth is not None:
+            max_depth = min(max_depth, self.max_depth)
+
+        valid_columns = [c for c in self.order if not (mask & self.top[c])]
+        choice = valid_columns[0]
+        self.depth = 0
+        for depth in range(1, max_depth + 1):
+            try:
+                best, best_score = None, -self.win_score - 1
+                for c in valid_columns:
+                    if self.alignment(position | ((mask + self.bottom[c]) & self.column_mask[c])):
+                        best, best_score = c, self.win_score - moves
+                        break
+                    score = -self.negamax(position ^ mask, mask | (mask + self.bottom[c]), moves + 1, depth - 1,
+                                          -self.win_score, -best_score)
+                    if score > best_score:
+                        best, best_score = c, score
+            except SearchTimeout:
+                break
+            choice, self.depth = best, depth
+            # the best move of this depth is searched first at the next one
+            valid_columns.remove(best)
+            valid_columns.insert(0, best)
+            # no need to go deeper once the result of the game is known
+            if abs(best_score) > self.n_positions:
+                break
+        elapsed = time.perf_counter() - start
+        self.nps = self.nodes / elapsed if elapsed > 0 else 0
+        self.choice = choice
 
 #---------------------------------------------------------------------------------------------       
-import tensorflow as tf
-def df_to_tensor(dataset):
-    df = dataset.copy()
-    df.drop(columns=['player', 'move'], inplace=True)
-    # stacking all the columns to get just one feature to train the RNN with 
-    df['grid'] = df[df.columns[1:]].apply(lambda x: np.concatenate(x), axis=1)
-    # dropping all the single columns 
-    df.drop(columns=df.columns[1:-1], inplace=True)
-    # padding inside the dataframe
-    df, mean_duration = padding(df)
-    # we are going to use the last mean_duration moves for each game
-    df = df.groupby(df.index).tail(mean_duration)
-    # with the following procedure, we build the tensorflow datasets stacking together all the column vectors
-    # for the features dataset and all the final moves for the target dataset
-    features = tf.data.Dataset.from_tensor_slices(list(df['grid']))
-    features = features.batch(mean_duration)
-    # taking the last move (the winning one) as target
-    targets = tf.data.Dataset.from_tensor_slices(list(df['choice'].groupby(df.index).tail(1)))
-    df = tf.data.Dataset.zip((features, targets))
-    return df
+# the features are built by the vectorized functions inside dataset_tools.py, directly from the flat 
+# int8 boards and the game offsets: the last mean_duration boards of each game, with the shorter games
+# padded with empty boards at the beginning, and the winning move as target
+# expand=True and mirror=True expand the training samples (see arrays_to_tensor())
+def df_to_tensor(dataset, expand=False, mirror=False):
+    from tools.dataset_tools import dataframe_to_records, game_offsets, arrays_to_tensor
+    records, grid_size = dataframe_to_records(dataset)
+    return arrays_to_tensor(records['boards'], game_offsets(records['game']), records['choice'],
+                            expand=expand, mirror=mirror, grid_size=grid_size)
 
 #---------------------------------------------------------------------------------------------
-def quickdraw_dataset(dataset, batch_size=32, shuffle_buffer_size=None, cache=False):
+def quickdraw_dataset(dataset, batch_size=32, shuffle_buffer_size=None, cache=False, prefetch=False):
     if cache:
-        # cache the dataset
-        dataset = dataset.cache()
+        # cache the dataset (in memory, or inside a file if cache is a path: useful with stream_dataset())
+        dataset = dataset.cache(cache if isinstance(cache, str) else '')
     if shuffle_buffer_size:
         # shuffle the dataset's batches
         dataset = dataset.shuffle(shuffle_buffer_size)
     # batch the games into batches of length 32, meaning that each batch will contain 32 games
     dataset = dataset.batch(batch_size) 
+    if prefetch:
+        # the next batches get prepared while the model is training on the current one
+        import tensorflow as tf
+        dataset = dataset.prefetch(tf.data.AUTOTUNE)
     return dataset
\ No newline at end of file
@@ -0,0 +1,98 @@
+import math
+import time
+import numpy as np
+import pandas as pd
+
+#---------------------------------------------------------------------------------------------
+# opt-in instrumentation: named timers and counters around the phases of the games and simulations
+# the instrumented code only checks `if profiler is not None`, so without a profiler the cost is a
+# single comparison for each phase
+# the durations are not stored one by one (millions of moves would need too much memory): each timer
+# keeps its total, its number of calls, its maximum and a histogram with 20 logarithmic bins for each
+# decade (from 10 ns to 1000 s), which gives the percentiles within ~6% and can be summed across workers
+bins_per_decade = 20
+min_exponent, max_exponent = -8, 3
+n_bins = (max_exponent - min_exponent) * bins_per_decade
+bin_edges = 10 ** (min_exponent + np.arange(n_bins + 1) / bins_per_decade)
+
+class Profiler(object):
+    def __init__(self):
+        self.timers = {}        # name -> [calls, total time, max time, histogram]
+        self.counters = {}      # name -> total
+
+    # usage: start = profiler.start(), then profiler.stop('phase', start) at the end of the phase
+    def start(self):
+        return time.perf_counter()
+
+    def stop(self, name, start):
+        self.add(name, time.perf_counter() - start)
+
+    def add(self, name, elapsed):
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = [0, 0.0, 0.0, np.zeros(n_bins, dtype=np.int64)]
+            self.timers[name] = timer
+        timer[0] += 1
+        timer[1] += elapsed
+        if elapsed > timer[2]:
+            timer[2] = elapsed
+        index = int((math.log10(elapsed) - min_exponent) * bins_per_decade) if elapsed > 0 else 0
+        timer[3][min(max(index, 0), n_bins - 1)] += 1
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    # plain dictionaries, to send the results of a worker process back to the main one
+    def to_dict(self):
+        return {'timers' : {name : [calls, total, peak, histogram.copy()]
+                            for name, (calls, total, peak, histogram) in self.timers.items()},
+                'counters' : dict(self.counters)}
+
+    def merge(self, other):
+        other = other.to_dict() if isinstance(other, Profiler) else other
+        for name, (calls, total, peak, histogram) in other['timers'].items():
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [calls, total, peak, np.array(histogram)]
+            else:
+                timer[0] += calls
+                timer[1] += total
+                timer[2] = max(timer[2], peak)
+                timer[3] += histogram
+        for name, value in other['counters'].items():
+            self.count(name, value)
+        return self
+
+    def percentile(self, name, q):
+        histogram = self.timers[name][3]
+        position = np.searchsorted(np.cumsum(histogram), q / 100 * histogram.sum())
+        # geometric center of the bin
+        return math.sqrt(bin_edges[position] * bin_edges[position + 1])
+
+    # nested phases are named after their parent, e.g. 'game/update_grid' inside 'game'
+    def parent(self, name):
+        return name.rsplit('/', 1)[0] if '/' in name else None
+
+    # one row for each timer: calls, total and mean time, share of the total time of the top level phases
+    # (the ones whose parent was not timed) and the percentiles, in seconds
+    def summary(self, percentiles=(50, 90, 99)):
+        rows = {}
+        top_level = sum(timer[1] for name, timer in self.timers.items() if self.parent(name) not in self.timers)
+        for name, (calls, total, peak, histogram) in self.timers.items():
+            row = {'calls' : calls, 'total' : total, 'mean' : total / calls if calls else 0.0,
+                   'share' : total / top_level if top_level else 0.0}
+            for q in percentiles:
+                row[f'p{q}'] = self.percentile(name, q)
+            row['max'] = peak
+            rows[name] = row
+        return pd.DataFrame.from_dict(rows, orient='index').sort_index()
+
+    def report(self, percentiles=(50, 90, 99)):
+        table = self.summary(percentiles)
+        print(f'{"phase":28s}{"calls":>10s}{"total (s)":>12s}{"share":>8s}{"mean (us)":>12s}'
+              + ''.join(f'{f"p{q} (us)":>12s}' for q in percentiles))
+        for name, row in table.iterrows():
+            print(f'{name:28s}{int(row["calls"]):10d}{row["total"]:12.4f}{100 * row["share"]:7.1f}%'
+                  f'{1e6 * row["mean"]:12.1f}' + ''.join(f'{1e6 * row[f"p{q}"]:12.1f}' for q in percentiles))
+        for name, value in self.counters.items():
+            print(f'{name:28s}{value:10d}')
@@ -0,0 +1,307 @@
+import os
+import time
+import queue
+import threading
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+from collections import deque
+from tools.game_tools import simulate_shard
+from tools.dataset_tools import game_offsets
+from tools.inference_tools import NumpyModel
+from tools.player_tools import quickdraw_dataset
+
+#---------------------------------------------------------------------------------------------
+# replay buffer: the boards of the last games are kept inside a single int8 ring (one row for each move,
+# column by column as in the game records) together with the choices; the games are stored contiguously
+# and the write head sweeps the ring, so the games reached by the head get evicted
+#   - 'fifo': the oldest games are simply overwritten
+#   - 'priority': the games reached by the head whose priority is in the top `keep` fraction of the buffer
+#     survive, copied again at the head (at most once for each new game, so the copies never cost more
+#     than the games themselves); with equal priorities this is the same as 'fifo'
+# the buffer is shared by the collector thread (add_records) and the training pipeline (sample), so every
+# access goes through a lock
+class ReplayBuffer(object):
+    def __init__(self, capacity=1_000_000, grid_size=(6,7), n_connect=4, eviction='fifo', keep=0.25,
+                 refresh=64):
+        if eviction not in ['fifo', 'priority']:
+            raise ValueError(f'Eviction {eviction} is not supported, choose between fifo and priority.')
+        self.capacity = capacity            # number of moves (boards) stored
+        self.height, self.width = grid_size
+        self.n_cells = self.height * self.width
+        self.eviction = eviction
+        self.keep = keep                    # fraction of the games that survive the head (priority eviction)
+        self.refresh = refresh              # the priority threshold is updated every `refresh` games
+        self.boards = np.zeros(shape=(capacity, self.n_cells), dtype=np.int8)
+        self.choice = np.zeros(capacity, dtype=np.int8)
+
+        # game table: a decisive game lasts at least 2n-1 moves, so there is always a free slot
+        self.max_games = capacity // (2 * n_connect - 1) + 1
+        self.start = np.zeros(self.max_games, dtype=np.int64)
+        self.length = np.zeros(self.max_games, dtype=np.int64)
+        self.priority = np.zeros(self.max_games, dtype=np.float64)
+        self.version = np.zeros(self.max_games, dtype=np.int64)
+        self.written = np.zeros(self.max_games, dtype=np.int64)    # number of the add that wrote the game
+        self.alive = np.zeros(self.max_games, dtype=bool)
+        self.free = list(range(self.max_games))[::-1]
+        self.order = deque()                # slots of the live games, from the oldest to the newest one
+        self.head = 0
+        self.threshold = np.inf
+        self.live = None                    # slots of the live games as an array, rebuilt after each add
+        self.lock = threading.Lock()
+        # statistics
+        self.added = 0
+        self.evicted = 0
+        self.kept = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def n_moves(self):
+        with self.lock:
+            return int(self.length[self.alive].sum())
+
+    # priority eviction: the threshold of the top `keep` fraction of the live games
+    def update_threshold(self):
+        priorities = self.priority[self.alive]
+        self.threshold = np.quantile(priorities, 1 - self.keep) if len(priorities) else np.inf
+
+    def evict(self, slot, survivors):
+        self.alive[slot] = False
+        self.free.append(slot)
+        start, length = self.start[slot], self.length[slot]
+        # a game copied during the current add is not kept a second time
+        if (self.eviction == 'priority') and (self.priority[slot] > self.threshold) \
+           and (self.written[slot] != self.added):
+            survivors.append((self.boards[start:start + length].copy(), self.choice[start:start + length].copy(),
+                              self.priority[slot], self.version[slot]))
+            self.kept += 1
+        else:
+            self.evicted += 1
+
+    # frees the next `length` moves after the head, starting over from the beginning of the ring when the
+    # game does not fit before its end
+    def reserve(self, length, survivors):
+        if self.head + length > self.capacity:
+            while self.order and (self.start[self.order[0]] >= self.head):
+                self.evict(self.order.popleft(), survivors)
+            self.head = 0
+        while self.order and (self.head <= self.start[self.order[0]] < self.head + length):
+            self.evict(self.order.popleft(), survivors)
+
+    def write(self, boards, choice, priority, version):
+        length = len(choice)
+        survivors = []
+        self.reserve(length, survivors)
+        if not self.free:
+            self.evict(self.order.popleft(), [])
+        slot = self.free.pop()
+        self.boards[self.head:self.head + length] = boards
+        self.choice[self.head:self.head + length] = choice
+        self.start[slot] = self.head
+        self.length[slot] = length
+        self.priority[slot] = priority
+        self.version[slot] = version
+        self.written[slot] = self.added
+        self.alive[slot] = True
+        self.order.append(slot)
+        self.head += length
+        return survivors
+
+    def add_game(self, boards, choice, priority=1.0, version=0):
+        if len(choice) > self.capacity:
+            raise ValueError(f'A game of {len(choice)} moves does not fit inside a buffer of {self.capacity} moves.')
+        with self.lock:
+            self.added += 1
+            if (self.eviction == 'priority') and ((self.added - 1) % self.refresh == 0):
+                self.update_threshold()
+            pending = [(boards, choice, priority, version)]
+            while pending:
+                pending.extend(self.write(*pending.pop()))
+            self.live = None
+
+    # records: the arrays returned by simulate_shard() or simulation(as_arrays=True), one priority per game
+    def add_records(self, records, priorities=None, version=0):
+        offsets = game_offsets(records['game'])
+        for i in range(len(offsets) - 1):
+            moves = slice(offsets[i], offsets[i + 1])
+            priority = 1.0 if priorities is None else priorities[i]
+            self.add_game(records['boards'][moves], records['choice'][moves], priority, version)
+
+    # n training windows, with the same features and targets of build_windows()/sample_windows() in
+    # dataset_tools.py: the games are drawn uniformly, then the final move (or, with expand=True, any move
+    # of the winner) becomes the target and the mean_duration boards up to it the features (int8, padded
+    # with empty boards at the beginning); with mirror=True half of the samples are mirrored
+    def sample(self, n, mean_duration, expand=True, mirror=False, rng=None):
+        rng = np.random.default_rng() if rng is None else rng
+        with self.lock:
+            if not self.order:
+                raise ValueError('The replay buffer is empty.')
+            if self.live is None:
+                self.live = np.fromiter(self.order, dtype=np.int64, count=len(self.order))
+            slots = self.live[rng.integers(0, len(self.live), size=n)]
+            start, length = self.start[slots], self.length[slots]
+            last = start + length - 1
+            if expand:
+                # the winner made the last move of the game, so its moves have the same parity
+                last = last - 2 * rng.integers(0, (length + 1) // 2)
+            index = last[:, None] - mean_duration + 1 + np.arange(mean_duration)
+            valid = index >= start[:, None]
+            features = np.zeros(shape=(n, mean_duration, self.n_cells), dtype=np.int8)
+            features[valid] = self.boards[index[valid]]
+            targets = self.choice[last].astype(np.int64)
+        if mirror:
+            flip = rng.random(n) < 0.5
+            shape = (-1, mean_duration, self.width, self.height)
+            features[flip] = features[flip].reshape(shape)[:, :, ::-1].reshape(-1, mean_duration, self.n_cells)
+            targets[flip] = self.width - 1 - targets[flip]
+        return features, targets
+
+    def stats(self):
+        with self.lock:
+            return {'games' : len(self.order), 'moves' : int(self.length[self.alive].sum()), 'added' : self.added,
+                    'evicted' : self.evicted, 'kept' : self.kept,
+                    'mean_version' : float(self.version[self.alive].mean()) if self.order else 0.0}
+
+# endless tf.data.Dataset with the same structure of df_to_tensor(): (mean_duration, cells) float64 sequences
+# with their int64 target, sampled from the buffer block by block; quickdraw_dataset() can be used on top of
+# it as usual (with prefetch=True, the next batches get sampled while the model is training)
+# the generator is created only once: each fit() call starts a new iterator, which must continue the same
+# random stream instead of replaying it from the seed
+def buffer_dataset(buffer, mean_duration, block_size=256, expand=True, mirror=False, seed=None):
+    import tensorflow as tf
+    rng = np.random.default_rng(seed)
+    def blocks():
+        while True:
+            yield buffer.sample(block_size, mean_duration, expand, mirror, rng)
+    dataset = tf.data.Dataset.from_generator(blocks, output_signature=(
+        tf.TensorSpec(shape=(None, mean_duration, buffer.n_cells), dtype=tf.int8),
+        tf.TensorSpec(shape=(None,), dtype=tf.int64)))
+    return dataset.unbatch().map(lambda x, y: (tf.cast(x, tf.float64), y))
+
+#---------------------------------------------------------------------------------------------
+# the weights are published as the NumPy version of the model (see inference_tools.py): the file is
+# written next to the final one and then renamed, so the workers never read a partially written file
+def publish_model(model, path, version):
+    NumpyModel.from_keras(model).save(f'{path}.tmp.npz', version)
+    os.replace(f'{path}.tmp.npz', f'{path}.npz')
+
+# self-play worker (one process each): plays chunks of games with the latest published weights, reloading
+# them between two chunks as soon as the file changes, and sends the games to the main process
+# the queue is bounded, so the workers wait for the buffer when they get too far ahead of it
+def selfplay_worker(games, stop, path, game_types, games_per_chunk, mean_duration, engine, seed, grid_size,
+                    n_connect):
+    seeds = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    model, stamp = None, None
+    chunk = 0
+    while not stop.is_set():
+        current = os.stat(f'{path}.npz').st_mtime_ns
+        if current != stamp:
+            model, stamp = NumpyModel.load(f'{path}.npz'), current
+        game_type = game_types[chunk % len(game_types)]
+        records = simulate_shard(games_per_chunk, game_type, model, mean_duration, engine, seeds.spawn(1)[0],
+                                 grid_size=grid_size, n_connect=n_connect)
+        chunk += 1
+        while not stop.is_set():
+            try:
+                games.put((records, model.version), timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+#---------------------------------------------------------------------------------------------
+# asynchronous self-play: the workers keep playing with the latest weights, a collector thread moves their
+# games into the replay buffer and the trainer (train()) fits the model on batches sampled from the buffer,
+# publishing the new weights after each round; none of them waits for the others, except for the first
+# min_games games, needed before the first round
+# priority (optional): function of the records of a chunk returning one priority for each game
+class SelfPlay(object):
+    def __init__(self, model, path, game_type='rnn-simple', buffer=None, workers=None, mean_duration=21,
+                 games_per_chunk=20, queue_size=64, engine='bitboard', priority=None, seed=None, grid_size=(6,7),
+                 n_connect=4):
+        self.model = model                  # compiled Keras model
+        self.path = path                    # published weights: f'{path}.npz'
+        self.game_types = [game_type] if isinstance(game_type, str) else list(game_type)
+        if not all('rnn' in t for t in self.game_types):
+            raise ValueError('The self-play games must involve the neural player (rnn-...).')
+        self.buffer = ReplayBuffer(grid_size=grid_size, n_connect=n_connect) if buffer is None else buffer
+        self.workers = max((os.cpu_count() or 2) - 1, 1) if workers is None else workers
+        self.mean_duration = mean_duration
+        self.games_per_chunk = games_per_chunk
+        self.engine = engine
+        self.priority = priority
+        self.seeds = np.random.SeedSequence(seed)
+        self.grid_size = tuple(grid_size)
+        self.n_connect = n_connect
+        self.version = 0
+        self.history = []
+        # the workers only need NumPy: they are started with 'spawn', so they do not inherit TensorFlow
+        self.context = mp.get_context('spawn')
+        self.games = self.context.Queue(maxsize=queue_size)
+        self.stop = self.context.Event()
+        self.processes = []
+        self.collector = None
+        self.collecting = threading.Event()
+        self.played = 0
+
+    def start(self):
+        self.stop.clear()
+        publish_model(self.model, self.path, self.version)
+        for seed in self.seeds.spawn(self.workers):
+            process = self.context.Process(target=selfplay_worker, daemon=True,
+                                           args=(self.games, self.stop, self.path, self.game_types,
+                                                 self.games_per_chunk, self.mean_duration, self.engine, seed,
+                                                 self.grid_size, self.n_connect))
+            process.start()
+            self.processes.append(process)
+        self.collecting.set()
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def collect(self):
+        while self.collecting.is_set():
+            try:
+                records, version = self.games.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            priorities = None if self.priority is None else self.priority(records)
+            self.buffer.add_records(records, priorities, version)
+            self.played += len(game_offsets(records['game'])) - 1
+
+    # the dataset is built only once: each round trains on steps_per_round batches, then publishes the weights
+    def train(self, rounds=10, steps_per_round=100, batch_size=32, min_games=1000, expand=True, mirror=False,
+              verbose=True):
+        if self.collector is None:
+            self.start()
+        dataset = quickdraw_dataset(buffer_dataset(self.buffer, self.mean_duration, expand=expand, mirror=mirror,
+                                                   seed=self.seeds.spawn(1)[0]),
+                                    batch_size=batch_size, prefetch=True)
+        while len(self.buffer) < min_games:
+            if not any(process.is_alive() for process in self.processes):
+                raise RuntimeError('All the self-play workers stopped before filling the replay buffer.')
+            time.sleep(0.1)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            history = self.model.fit(dataset, steps_per_epoch=steps_per_round, epochs=1, verbose=0)
+            self.version += 1
+            publish_model(self.model, self.path, self.version)
+            row = {'version' : self.version, 'seconds' : time.perf_counter() - start, 'played' : self.played}
+            row.update({key : values[-1] for key, values in history.history.items()})
+            row.update(self.buffer.stats())
+            self.history.append(row)
+            if verbose:
+                print(', '.join(f'{key}: {value:.4g}' if isinstance(value, float) else f'{key}: {value}'
+                                for key, value in row.items()))
+        return pd.DataFrame(self.history).set_index('version')
+
+    # the workers are stopped first, while the collector keeps draining the queue (a process cannot exit
+    # while its queued games are not consumed)
+    def close(self):
+        self.stop.set()
+        for process in self.processes:
+            process.join()
+        self.collecting.clear()
+        if self.collector is not None:
+            self.collector.join()
+        self.processes = []
+        self.collector = None